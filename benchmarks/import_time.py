@@ -0,0 +1,75 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Check what loading the plugin costs every `qiime` invocation. Measures
+# `import q2_beast.plugin_setup` with `python -X importtime`, subtracts the
+# framework it necessarily loads (qiime2 and q2-types), and fails if the
+# rest is over budget or pulls in libraries only an action should need.
+# q2_beast/tests/test_import_time.py runs the same check under py.test.
+#
+#   python benchmarks/import_time.py
+
+import subprocess
+import sys
+
+BUDGET_MS = 100
+FRAMEWORK = ('import qiime2.plugin, q2_types.feature_data, q2_types.tree')
+LAZY_MODULES = ['jinja2', 'altair', 'pkg_resources']
+
+
+def _cumulative_us(statement):
+    # the slowest top level import of the statement, -X importtime writes
+    # "import time: self [us] | cumulative | imported package" to stderr
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              statement],
+                             stderr=subprocess.PIPE, universal_newlines=True,
+                             check=True)
+    total = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        if not package.startswith(' ' * 2):  # top level, not nested
+            total += int(cumulative)
+    return total
+
+
+def _loaded(modules):
+    check = ('import sys, q2_beast.plugin_setup;'
+             ' print(" ".join(m for m in %r if m in sys.modules))' % modules)
+    process = subprocess.run([sys.executable, '-c', check],
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True)
+    return process.stdout.split()
+
+
+def measure():
+    # milliseconds the plugin adds on top of the framework, and which of
+    # LAZY_MODULES it loaded
+    framework = _cumulative_us(FRAMEWORK)
+    plugin = _cumulative_us(FRAMEWORK + '; import q2_beast.plugin_setup')
+    return (plugin - framework) / 1000, _loaded(LAZY_MODULES)
+
+
+def main():
+    own_ms, loaded = measure()
+    print('import q2_beast.plugin_setup: %.1f ms on top of qiime2 and'
+          ' q2-types (budget %d ms)' % (own_ms, BUDGET_MS))
+
+    failed = False
+    if own_ms > BUDGET_MS:
+        print('over budget')
+        failed = True
+    if loaded:
+        print('imported while loading the plugin: %s' % ', '.join(loaded))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# Time rendering of the gtr_single_partition control file for a small and a
+# large sample set, loading the template the way `_get_template` used to
+# (a new environment every call) and through the cached environment.
+#
+#   python benchmarks/render_control_file.py
+
+import os
+import tempfile
+import time
+
+import jinja2
+import numpy as np
+import pandas as pd
+
+from q2_beast import methods
+
+TEMPLATE = 'gtr_single_partition.xml'
+CASES = [
+    # label, samples, sites, repeats
+    ('small', 10, 1000, 200),
+    ('large', 2000, 30000, 3),
+]
+
+
+def _uncached_template(name):
+    path = os.path.join(os.path.dirname(methods.__file__), 'xml-templates')
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=path))
+    return env.get_template(name)
+
+
+def _template_kwargs(n_samples, n_sites):
+    rng = np.random.default_rng(0)
+    ids = pd.Index(['taxon%d' % i for i in range(n_samples)])
+    times = pd.Series(rng.uniform(2019, 2021, n_samples), index=ids)
+    matrix = rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8),
+                        size=(n_samples, n_sites))
+    samples = methods._Samples(ids, times, None, seq=matrix)
+    return dict(trees_file='posterior.trees', ops_file='posterior.ops',
+                log_file='posterior.log', sample_every=1000,
+                print_every=1000, n_generations=1000000, time_unit='years',
+                samples=samples, base_freq='estimated', site_gamma=4,
+                site_invariant=True, clock='ucln', coalescent_model='skygrid',
+                skygrid_duration=5.0, skygrid_intervals=50)
+
+
+def _best_of(get_template, template_kwargs, repeats, out):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        get_template(TEMPLATE).stream(**template_kwargs).dump(out)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'control_file.xml')
+        for label, n_samples, n_sites, repeats in CASES:
+            template_kwargs = _template_kwargs(n_samples, n_sites)
+            uncached = _best_of(_uncached_template, template_kwargs,
+                                repeats, out)
+            cached = _best_of(methods._get_template, template_kwargs,
+                              repeats, out)
+            print('%-5s %5d samples x %5d sites: uncached %8.4fs'
+                  '  cached %8.4fs' % (label, n_samples, n_sites, uncached,
+                                       cached))
+
+
+if __name__ == '__main__':
+    main()
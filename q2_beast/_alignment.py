@@ -0,0 +1,69 @@
+import numpy as np
+
+
+# characters which carry no information about a site
+MISSING = np.frombuffer(b'-.?N', dtype=np.uint8)
+
+
+def encode(sequences):
+    # one row per sequence of single byte character codes, filled a row at a
+    # time so there is never more than one extra copy of a sequence
+    sequences = list(sequences)
+    lengths = {len(s) for s in sequences}
+    if len(lengths) > 1:
+        raise ValueError("Sequences are not aligned, found lengths: %r"
+                         % sorted(lengths))
+    width = lengths.pop() if lengths else 0
+    matrix = np.empty((len(sequences), width), dtype=np.uint8)
+    for row, sequence in zip(matrix, sequences):
+        row[:] = np.frombuffer(str(sequence).upper().encode('ascii'),
+                               dtype=np.uint8)
+    return matrix
+
+
+def decode(row):
+    return row.tobytes().decode('ascii')
+
+
+_HASH_MULTIPLIER = np.uint64(0x100000001b3)  # 64-bit FNV prime
+
+
+def column_hashes(matrix):
+    # one hash per site, built a taxon at a time so only a single row of
+    # uint64 is ever allocated
+    hashes = np.zeros(matrix.shape[1], dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for row in matrix:
+            hashes *= _HASH_MULTIPLIER
+            hashes ^= row
+    return hashes
+
+
+def count_patterns(matrix):
+    return len(np.unique(column_hashes(matrix)))
+
+
+def sites_to_keep(matrix, codons=False):
+    # Sites which are missing for every taxon contribute nothing to the
+    # likelihood. Constant sites do, so they are always kept.
+    all_missing = np.ones(matrix.shape[1], dtype=bool)
+    for row in matrix:
+        all_missing &= np.isin(row, MISSING)
+
+    keep = ~all_missing
+    if codons:
+        # only whole codons can be dropped without shifting positions
+        end = len(keep) - len(keep) % 3
+        keep[:end] = keep[:end].reshape(-1, 3).any(axis=1).repeat(3)
+    return keep
+
+
+def preprocess(sequences, codons=False):
+    # only empty sites are dropped, BEAST compresses the rest into unique
+    # site patterns itself
+    matrix = encode(sequences)
+    keep = sites_to_keep(matrix, codons=codons)
+    if not keep.all():
+        matrix = matrix[:, keep]
+    return matrix, dict(sites=len(keep), kept_sites=int(keep.sum()),
+                        patterns=count_patterns(matrix))
@@ -0,0 +1,225 @@
+import collections
+import re
+
+import numpy as np
+
+from q2_beast._nexus import format_newick, newick_tokens, parse_newick
+
+
+HPD_PROPORTION = 0.95
+HEIGHTS = ['keep', 'mean', 'median', 'ca']
+
+_RATE = re.compile(r'[&,]rate=([^,\]]+)')
+
+# one entry per node of a tree in postorder, so the root is last
+Nodes = collections.namedtuple('Nodes', ['clades', 'parents', 'heights',
+                                         'rates'])
+
+
+def node_table(newick, bits):
+    clades = []
+    parents = []
+    lengths = []
+    rates = []
+    open_nodes = []
+    last = None
+    for token in newick_tokens(newick):
+        if token == '(':
+            open_nodes.append([])
+            continue
+        elif token == ')':
+            last = len(clades)
+            clade = 0
+            for child in open_nodes.pop():
+                clade |= clades[child]
+                parents[child] = last
+            clades.append(clade)
+        elif token == ',':
+            continue
+        elif token == ';':
+            break
+        elif token[0] == ':':
+            lengths[last] = float(token[1:])
+            continue
+        elif token[0] == '[':
+            match = _RATE.search(token)
+            if match is not None:
+                rates[last] = float(match.group(1))
+            continue
+        else:
+            last = len(clades)
+            clades.append(bits[token])
+        parents.append(-1)
+        lengths.append(0.0)
+        rates.append(np.nan)
+        if open_nodes:
+            open_nodes[-1].append(last)
+
+    parents = np.array(parents)
+    depths = np.zeros(len(clades))
+    for node in range(len(clades) - 2, -1, -1):
+        depths[node] = depths[parents[node]] + lengths[node]
+    return Nodes(clades, parents, depths.max() - depths, np.array(rates))
+
+
+class CladeSamples:
+    # The values of every sampled node whose clade is in the summary tree.
+    # Each clade owns a contiguous segment of one flat array, sized by how
+    # often it was sampled, so nothing is allocated while streaming.
+    def __init__(self, clades, sizes):
+        self.keys = {clade: key for key, clade in enumerate(clades)}
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        self.filled = np.zeros(len(clades), dtype=int)
+        self.heights = np.empty(self.offsets[-1])
+        self.rates = np.empty(self.offsets[-1])
+
+    def add(self, keys, heights, rates=None):
+        positions = self.offsets[keys] + self.filled[keys]
+        self.heights[positions] = heights
+        if rates is not None:
+            self.rates[positions] = rates
+        self.filled[keys] += 1
+
+    def add_tree(self, nodes):
+        keys = np.array([self.keys.get(clade, -1) for clade in nodes.clades])
+        found = keys >= 0
+        self.add(keys[found], nodes.heights[found], nodes.rates[found])
+
+    @classmethod
+    def from_entries(cls, clades, keys, heights, rates):
+        # every value at once, `keys` being the clade of each value
+        sizes = np.bincount(keys, minlength=len(clades))
+        samples = cls(clades, sizes)
+        order = np.argsort(keys, kind='stable')
+        samples.heights[:] = heights[order]
+        samples.rates[:] = rates[order]
+        samples.filled[:] = sizes
+        return samples
+
+
+def summarize(values, offsets):
+    # Mean, median, HPD interval and range of every segment of `values`, all
+    # segments at once. The HPD is the narrowest interval holding
+    # round(HPD_PROPORTION * n) sorted samples, the first one on ties, as
+    # treeannotator does.
+    sizes = np.diff(offsets)
+    starts = offsets[:-1]
+    segments = np.repeat(np.arange(len(sizes)), sizes)
+    ordered = values[np.lexsort((values, segments))]
+
+    mean = np.add.reduceat(ordered, starts) / sizes
+    median = (ordered[starts + (sizes - 1) // 2]
+              + ordered[starts + sizes // 2]) / 2
+
+    widths = np.maximum(np.floor(HPD_PROPORTION * sizes + 0.5), 1)
+    widths = widths.astype(int)[segments]
+    positions = np.arange(len(ordered))
+    fits = positions - starts[segments] <= sizes[segments] - widths
+    upper = np.minimum(positions + widths - 1, len(ordered) - 1)
+    spans = np.where(fits, ordered[upper] - ordered, np.inf)
+    narrowest = np.minimum.reduceat(spans, starts)
+    candidates = np.flatnonzero(spans == narrowest[segments])
+    _, first = np.unique(segments[candidates], return_index=True)
+    lower = candidates[first]
+
+    return dict(mean=mean, median=median,
+                hpd=(ordered[lower], ordered[lower + widths[lower] - 1]),
+                range=(ordered[starts], ordered[starts + sizes - 1]))
+
+
+def _mrca_nodes(nodes, mcc_children, mcc_clades):
+    # The node of a sampled tree which is the most recent common ancestor
+    # of each clade of the summary tree, built up from the summary tree's
+    # children as the ancestor of their ancestors.
+    levels = np.zeros(len(nodes.parents), dtype=int)
+    for node in range(len(levels) - 2, -1, -1):
+        levels[node] = levels[nodes.parents[node]] + 1
+    tips = {}
+    for node, clade in enumerate(nodes.clades):
+        tips.setdefault(clade, node)
+
+    mrca = []
+    for key, children in enumerate(mcc_children):
+        if not children:
+            mrca.append(tips[mcc_clades[key]])
+            continue
+        ancestor = mrca[children[0]]
+        for child in children[1:]:
+            other = mrca[child]
+            while ancestor != other:
+                if levels[ancestor] >= levels[other]:
+                    ancestor = nodes.parents[ancestor]
+                else:
+                    other = nodes.parents[other]
+        mrca.append(ancestor)
+    return mrca
+
+
+def _format(value):
+    return '%r' % float(value)
+
+
+def _attributes(name, stats, key):
+    low, high = stats['hpd']
+    first, last = stats['range']
+    return [
+        '%s=%s' % (name, _format(stats['mean'][key])),
+        '%s_median=%s' % (name, _format(stats['median'][key])),
+        '%s_95%%_HPD={%s,%s}' % (name, _format(low[key]), _format(high[key])),
+        '%s_range={%s,%s}' % (name, _format(first[key]), _format(last[key]))]
+
+
+def annotate(mcc_newick, trees, bits, counts, n_trees, heights='keep',
+             samples=None):
+    # `trees` is an iterable of the sampled newick strings, streamed once.
+    # `samples` can hold the summary tree's clades collected ahead of time,
+    # then the trees are only read for `ca` heights. Returns the summary
+    # tree with FigTree compatible annotations.
+    if heights not in HEIGHTS:
+        raise ValueError("heights must be one of %r." % HEIGHTS)
+    mcc = node_table(mcc_newick, bits)
+    collect = samples is None
+    if collect:
+        samples = CladeSamples(
+            mcc.clades, [counts.get(clade, n_trees) for clade in mcc.clades])
+    mcc_children = [[] for _ in mcc.clades]
+    for node, parent in enumerate(mcc.parents[:-1]):
+        mcc_children[parent].append(node)
+    if heights == 'ca':
+        ancestors = CladeSamples(mcc.clades, [n_trees] * len(mcc.clades))
+
+    if collect or heights == 'ca':
+        for newick in trees:
+            nodes = node_table(newick, bits)
+            if collect:
+                samples.add_tree(nodes)
+            if heights == 'ca':
+                mrca = _mrca_nodes(nodes, mcc_children, mcc.clades)
+                ancestors.add(np.arange(len(mrca)), nodes.heights[mrca])
+
+    height_stats = summarize(samples.heights, samples.offsets)
+    # strict clocks and the root have no rate to summarize
+    has_rate = (np.add.reduceat(~np.isnan(samples.rates),
+                                samples.offsets[:-1])
+                == np.diff(samples.offsets))
+    rate_stats = summarize(np.nan_to_num(samples.rates), samples.offsets)
+    if heights == 'ca':
+        node_heights = summarize(ancestors.heights,
+                                 ancestors.offsets)['mean']
+    elif heights != 'keep':
+        node_heights = height_stats[heights]
+
+    root = parse_newick(mcc_newick)
+    for key, node in enumerate(root.postorder()):
+        attributes = []
+        if node.children:
+            posterior = counts[mcc.clades[key]] / n_trees
+            attributes.append('posterior=%s' % _format(posterior))
+        attributes += _attributes('height', height_stats, key)
+        if has_rate[key]:
+            attributes += _attributes('rate', rate_stats, key)
+        node.comment = '&' + ','.join(attributes)
+        parent = mcc.parents[key]
+        if heights != 'keep' and parent >= 0:
+            node.length = float(node_heights[parent] - node_heights[key])
+    return format_newick(root)
@@ -0,0 +1,133 @@
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from q2_beast._cache import cache_dir
+
+
+PILOT_GENERATIONS = 10000
+_RESCALE_FREQUENCIES = [100, 1000]
+
+
+def default_settings(n_threads):
+    return dict(sse=True, instances=n_threads, threads=None, rescale=None)
+
+
+def beagle_flags(settings):
+    flags = ['-beagle_CPU',
+             '-beagle_SSE' if settings['sse'] else '-beagle_SSE_off',
+             '-beagle_instances', str(settings['instances'])]
+    if settings['threads'] is not None:
+        flags += ['-beagle_threads', str(settings['threads'])]
+    if settings['rescale'] is not None:
+        flags += ['-beagle_scaling', 'dynamic',
+                  '-beagle_rescale', str(settings['rescale'])]
+    return flags
+
+
+def _cache_path():
+    return os.path.join(cache_dir(), 'beagle.json')
+
+
+def _load_cache():
+    try:
+        with open(_cache_path()) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    path = _cache_path()
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                     delete=False) as fh:
+        json.dump(cache, fh, indent=2, sort_keys=True)
+    os.replace(fh.name, path)
+
+
+def cache_key(template_name, n_taxa, n_patterns, n_threads):
+    return '%s %s %dx%d %d' % (socket.gethostname(), template_name, n_taxa,
+                               n_patterns, n_threads)
+
+
+def _pilot(render, settings):
+    # seconds per generation, JVM startup is the same for every candidate
+    # so it does not change which one is fastest
+    with tempfile.TemporaryDirectory(prefix='q2-beast-pilot-') as tmp:
+        control_file = os.path.join(tmp, 'control_file.xml')
+        render(control_file)
+        start = time.perf_counter()
+        try:
+            subprocess.run(['beast'] + beagle_flags(settings)
+                           + [control_file], check=True, cwd=tmp,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return float('inf')  # unsupported on this machine
+        return (time.perf_counter() - start) / PILOT_GENERATIONS
+
+
+def _instance_counts(n_threads):
+    count = 1
+    while count < n_threads:
+        yield count
+        count *= 2
+    yield n_threads
+
+
+def tune(render, n_threads, key):
+    # `render` writes a short pilot control file to the path it is given
+    cache = _load_cache()
+    if key in cache:
+        return cache[key]['settings']
+
+    best = default_settings(n_threads)
+    best_time = _pilot(render, best)
+
+    def candidates():
+        # search one setting at a time, keeping the fastest of each
+        for instances in _instance_counts(n_threads):
+            yield dict(best, instances=instances,
+                       threads=n_threads // instances)
+        yield dict(best, sse=not best['sse'])
+        for rescale in _RESCALE_FREQUENCIES:
+            yield dict(best, rescale=rescale)
+
+    for candidate in candidates():
+        if candidate == best:
+            continue
+        elapsed = _pilot(render, candidate)
+        if elapsed < best_time:
+            best, best_time = candidate, elapsed
+
+    if best_time == float('inf'):
+        return best  # nothing ran, so there is nothing worth remembering
+
+    cache = _load_cache()
+    cache[key] = dict(settings=best, seconds_per_generation=best_time)
+    _save_cache(cache)
+    return best
+
+
+def allocate_threads(pattern_counts, n_threads):
+    # Split `n_threads` between partitions in proportion to their unique
+    # site patterns (largest remainder). Every partition gets at least one
+    # when there are enough to go round.
+    names = list(pattern_counts)
+    counts = np.array([pattern_counts[name] for name in names], dtype=float)
+    minimum = 1 if n_threads >= len(names) else 0
+    if counts.sum() == 0:
+        counts[...] = 1
+    quota = counts / counts.sum() * n_threads
+    threads = np.maximum(np.floor(quota), minimum).astype(int)
+    while threads.sum() > n_threads:
+        over = np.where(threads > minimum, threads - quota, -np.inf)
+        threads[over.argmax()] -= 1
+    remainder = np.argsort(threads - quota)[:n_threads - threads.sum()]
+    threads[remainder] += 1
+    return dict(zip(names, threads.tolist()))
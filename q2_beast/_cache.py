@@ -0,0 +1,9 @@
+import os
+
+
+def cache_dir(*parts):
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    path = os.path.join(base, 'q2-beast', *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
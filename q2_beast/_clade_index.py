@@ -0,0 +1,150 @@
+import concurrent.futures
+import os
+import tempfile
+
+import numpy as np
+
+from q2_beast._annotation import CladeSamples, node_table
+from q2_beast._nexus import shard_trees, tree_shards
+
+
+# Every node of every tree as one entry, trees being contiguous runs of
+# entries between `offsets`. `members` is the clade of each entry, an id
+# into `clades` which holds the bitsets packed little endian.
+ARRAYS = ['clades', 'states', 'offsets', 'members', 'heights', 'rates']
+
+# the per entry arrays, which are spilled to disk by each shard
+_ENTRIES = {'members': np.int64, 'heights': np.float64, 'rates': np.float64}
+
+
+def _spill_path(spill, name):
+    return os.path.join(spill, name + '.npy')
+
+
+def _index_shard(path, bits, begin, end, spill):
+    # The entries of the shard go to `spill` with `members` numbered by the
+    # shard, only the distinct clades it numbered come back.
+    ids = {}
+    states = []
+    sizes = []
+    entries = {name: [] for name in _ENTRIES}
+    for state, newick in shard_trees(path, begin, end, 0, 1):
+        nodes = node_table(newick, bits)
+        states.append(state)
+        sizes.append(len(nodes.clades))
+        entries['members'].append(np.array(
+            [ids.setdefault(clade, len(ids)) for clade in nodes.clades],
+            dtype=np.int64))
+        entries['heights'].append(nodes.heights)
+        entries['rates'].append(nodes.rates)
+    os.makedirs(spill)
+    for name, dtype in _ENTRIES.items():
+        np.save(_spill_path(spill, name),
+                np.concatenate(entries[name] or [[]]).astype(dtype))
+
+    width = (len(bits) + 7) // 8
+    packed = b''.join(clade.to_bytes(width, 'little') for clade in ids)
+    return states, sizes, packed
+
+
+def _assemble(indexed, spills, width, paths):
+    ids = {}
+    states = []
+    sizes = []
+    renumbered = []
+    for (shard_states, shard_sizes, packed) in indexed:
+        states += shard_states
+        sizes += shard_sizes
+        # the shard's numbering of its clades to the one of all the shards
+        renumbered.append(np.array(
+            [ids.setdefault(packed[at:at + width], len(ids))
+             for at in range(0, len(packed), width)], dtype=np.int64))
+
+    np.save(str(paths['clades']), np.frombuffer(
+        b''.join(ids), dtype=np.uint8).reshape(-1, width))
+    np.save(str(paths['states']), np.array(states, dtype=np.int64))
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    np.save(str(paths['offsets']), offsets)
+
+    # the entries are copied one shard at a time so only one is in memory
+    for name, dtype in _ENTRIES.items():
+        out = np.lib.format.open_memmap(str(paths[name]), mode='w+',
+                                        dtype=dtype, shape=(int(offsets[-1]),))
+        at = 0
+        for spill, shard_ids in zip(spills, renumbered):
+            entries = np.load(_spill_path(spill, name))
+            if name == 'members':
+                entries = shard_ids[entries]
+            out[at:at + len(entries)] = entries
+            at += len(entries)
+        out.flush()
+        del out
+
+
+def build(path, index, bits, paths, n_jobs=1):
+    # Writes the index of the trees at `path` to `paths`, one per ARRAYS.
+    # A few shards per process evens out their share of the work.
+    width = (len(bits) + 7) // 8
+    with tempfile.TemporaryDirectory(prefix='q2-beast-clades-') as tmp:
+        shards = [(path, bits, begin, end, os.path.join(tmp, str(shard)))
+                  for shard, (begin, end) in enumerate(tree_shards(
+                      index, 0, 1, n_jobs * 4 if n_jobs > 1 else 1))]
+        spills = [shard[-1] for shard in shards]
+        if n_jobs == 1:
+            _assemble(map(_index_shard, *zip(*shards)), spills, width, paths)
+            return
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            _assemble(pool.map(_index_shard, *zip(*shards)), spills, width,
+                      paths)
+
+
+def load(paths):
+    return {name: np.load(str(paths[name]), mmap_mode='r')
+            for name in ARRAYS}
+
+
+def _entry_selection(clade_index, selected):
+    return np.repeat(selected, np.diff(clade_index['offsets']))
+
+
+def selected_trees(clade_index, start=0, stride=1):
+    states = clade_index['states']
+    return (states >= start) & (states % stride == 0)
+
+
+def clade_counts(clade_index, selected):
+    # how many of the selected trees contain each clade
+    members = clade_index['members']
+    return np.bincount(members[_entry_selection(clade_index, selected)],
+                       minlength=len(clade_index['clades']))
+
+
+def best_tree(clade_index, counts, selected):
+    # position of the first selected tree with the highest log clade
+    # credibility, the tips count as clades but always score 0
+    with np.errstate(divide='ignore'):
+        log_credibility = np.log(counts / selected.sum())
+    scores = np.add.reduceat(log_credibility[clade_index['members']],
+                             clade_index['offsets'][:-1])
+    scores[~selected] = -np.inf
+    return int(np.argmax(scores))
+
+
+def clade_samples(clade_index, counts, selected, tree, tree_clades):
+    # The counts and a CladeSamples of `tree_clades`, which are the clades
+    # of the tree at position `tree` in the order they should be keyed.
+    offsets = clade_index['offsets']
+    ids = np.asarray(clade_index['members'][offsets[tree]:offsets[tree + 1]])
+    by_clade = {int.from_bytes(clade_index['clades'][id_].tobytes(),
+                               'little'): id_ for id_ in ids}
+    tree_ids = np.array([by_clade[clade] for clade in tree_clades])
+
+    keys = np.full(len(clade_index['clades']), -1)
+    keys[tree_ids] = np.arange(len(tree_ids))
+    entry_keys = keys[clade_index['members']]
+    found = (entry_keys >= 0) & _entry_selection(clade_index, selected)
+    samples = CladeSamples.from_entries(
+        tree_clades, entry_keys[found], clade_index['heights'][found],
+        clade_index['rates'][found])
+    return ({clade: int(counts[id_])
+             for clade, id_ in zip(tree_clades, tree_ids)}, samples)
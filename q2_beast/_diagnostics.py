@@ -0,0 +1,214 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+
+# memory for the spectra of the blocks of columns being transformed
+_FFT_BYTES = 1 << 28
+
+
+def _fft_size(n):
+    # the smallest 5-smooth number from n, which FFTs are fastest for
+    best = 1 << (n - 1).bit_length()
+    power_of_5 = 1
+    while power_of_5 < best:
+        odd = power_of_5
+        while odd < best:
+            best = min(best, odd << (-(-n // odd) - 1).bit_length())
+            odd *= 3
+        power_of_5 *= 5
+    return best
+
+
+def _autocovariance(series):
+    # along the last axis, so each FFT runs over contiguous memory
+    n_draws = series.shape[-1]
+    centered = series - series.mean(axis=-1, keepdims=True)
+    # pad to avoid the circular correlation of the FFT
+    size = _fft_size(2 * n_draws - 1)
+    spectrum = np.fft.rfft(centered, n=size, axis=-1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    del spectrum
+    return np.fft.irfft(power, n=size, axis=-1)[..., :n_draws] / n_draws
+
+
+def _autocorrelation(series):
+    # series is (parameters x draws)
+    acov = _autocovariance(series)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acov / acov[:, :1]
+
+
+def autocorrelation(samples):
+    # samples is (draws x parameters), every column is handled at once
+    samples = np.asarray(samples, dtype=float)
+    return _autocorrelation(np.ascontiguousarray(samples.T)).T
+
+
+def _integrated_autocorrelation_time(series):
+    rho = _autocorrelation(series)
+    n_pairs = rho.shape[1] // 2
+    pairs = rho[:, :2 * n_pairs].reshape(-1, n_pairs, 2).sum(axis=2)
+    positive = pairs > 0
+    first_negative = np.where(positive.all(axis=1), n_pairs,
+                              positive.argmin(axis=1))
+    pairs = np.where(np.arange(n_pairs) < first_negative[:, np.newaxis],
+                     pairs, 0)
+    pairs = np.minimum.accumulate(pairs, axis=1)
+    tau = -1 + 2 * pairs.sum(axis=1)
+    # constant columns have no defined autocorrelation
+    return np.where(np.isnan(rho[:, 0]), np.nan, np.maximum(tau, 1 / n_pairs))
+
+
+def _by_parameter(function, samples):
+    # Applies `function` to blocks of the parameters (the last axis of
+    # `samples`), moved first and contiguous. Blocks are small enough for
+    # their padded spectra to fit in memory, and run in parallel as numpy's
+    # FFT releases the GIL.
+    *shape, n_params = samples.shape
+    per_param = _fft_size(2 * shape[-1] - 1) * int(np.prod(shape[:-1])) * 16
+    workers = max(1, min(os.cpu_count() or 1, n_params))
+    block = max(1, _FFT_BYTES // workers // per_param)
+    block = min(block, -(-n_params // workers))
+
+    def transform(start):
+        return function(np.ascontiguousarray(
+            np.moveaxis(samples[..., start:start + block], -1, 0)))
+
+    starts = range(0, n_params, block)
+    if len(starts) == 1:
+        return transform(0)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return np.concatenate(list(pool.map(transform, starts)))
+
+
+def integrated_autocorrelation_time(samples):
+    # Geyer's initial monotone sequence estimator, samples is (draws x
+    # parameters)
+    samples = np.asarray(samples, dtype=float)
+    return _by_parameter(_integrated_autocorrelation_time, samples)
+
+
+def effective_sample_size(samples):
+    samples = np.asarray(samples, dtype=float)
+    return samples.shape[0] / integrated_autocorrelation_time(samples)
+
+
+# Acklam's rational approximation of the normal quantile function
+_CENTRAL_NUMERATOR = [-3.969683028665376e+01, 2.209460984245205e+02,
+                      -2.759285104469687e+02, 1.383577518672690e+02,
+                      -3.066479806614716e+01, 2.506628277459239e+00]
+_CENTRAL_DENOMINATOR = [-5.447609879822406e+01, 1.615858368580409e+02,
+                        -1.556989798598866e+02, 6.680131188771972e+01,
+                        -1.328068155288572e+01, 1.0]
+_TAIL_NUMERATOR = [-7.784894002430293e-03, -3.223964580411365e-01,
+                   -2.400758277161838e+00, -2.549732539343734e+00,
+                   4.374664141464968e+00, 2.938163982698783e+00]
+_TAIL_DENOMINATOR = [7.784695709041462e-03, 3.224671290700398e-01,
+                     2.445134137142996e+00, 3.754408661907416e+00, 1.0]
+_TAIL = 0.02425
+
+
+def normal_quantile(p):
+    p = np.asarray(p, dtype=float)
+    q = p - 0.5
+    r = q * q
+    x = (q * np.polyval(_CENTRAL_NUMERATOR, r)
+         / np.polyval(_CENTRAL_DENOMINATOR, r))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tail = np.sqrt(-2 * np.log(np.minimum(p, 1 - p)))
+    tail = (np.polyval(_TAIL_NUMERATOR, tail)
+            / np.polyval(_TAIL_DENOMINATOR, tail))
+    return np.where(p < _TAIL, tail, np.where(p > 1 - _TAIL, -tail, x))
+
+
+def _rank_normalize(series):
+    # series is (parameters x chains x draws), ranked over all the draws of
+    # every chain with ties sharing their average rank
+    pooled = series.reshape(len(series), -1)
+    n = pooled.shape[1]
+    order = np.argsort(pooled, axis=-1)
+    ordered = np.take_along_axis(pooled, order, axis=-1)
+    positions = np.broadcast_to(np.arange(n), pooled.shape)
+    changes = ordered[:, 1:] != ordered[:, :-1]
+    edge = np.ones((len(pooled), 1), dtype=bool)
+    starts = np.concatenate([edge, changes], axis=1)
+    ends = np.concatenate([changes, edge], axis=1)
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(
+        np.where(ends, positions, n - 1)[:, ::-1], axis=1)[:, ::-1]
+    # first + last is twice the rank less two, so the z-scores of every
+    # parameter come from one table
+    table = normal_quantile((np.arange(2 * n - 1) / 2 + 0.625) / (n + 0.25))
+    z = np.empty(pooled.shape)
+    np.put_along_axis(z, order, table[first + last], axis=1)
+    return z.reshape(series.shape)
+
+
+def _split(series):
+    # each chain becomes its first and last half, the middle draw of an odd
+    # number is dropped
+    half = series.shape[-1] // 2
+    return np.concatenate([series[..., :half], series[..., -half:]], axis=1)
+
+
+def _rhat(series):
+    n_draws = series.shape[-1]
+    between = n_draws * series.mean(axis=-1).var(axis=-1, ddof=1)
+    within = series.var(axis=-1, ddof=1).mean(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt((between / within + n_draws - 1) / n_draws)
+
+
+def _multi_chain_ess(series):
+    # Geyer's initial monotone sequence over the autocorrelations combined
+    # across chains (Vehtari et al. 2021), for every parameter at once
+    n_params, n_chains, n_draws = series.shape
+    acov = _autocovariance(series)
+    mean_var = acov[..., 0].mean(axis=-1) * n_draws / (n_draws - 1)
+    var_plus = mean_var * (n_draws - 1) / n_draws
+    if n_chains > 1:
+        var_plus = var_plus + series.mean(axis=-1).var(axis=-1, ddof=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = 1 - (mean_var[:, np.newaxis] - acov.mean(axis=1)) \
+            / var_plus[:, np.newaxis]
+    rho[:, 0] = 1
+
+    n_pairs = len(range(1, n_draws - 3, 2))
+    pairs = rho[:, :2 * (n_pairs + 1)].reshape(n_params, -1, 2).sum(axis=-1)
+    stops = pairs[:, 1:] <= 0
+    kept = np.where(stops.any(axis=1), stops.argmax(axis=1) + 1, n_pairs)
+    params = np.arange(n_params)
+    monotone = np.minimum.accumulate(pairs, axis=1)
+    tau = -1 + 2 * np.where(np.arange(n_pairs + 1) < kept[:, np.newaxis],
+                            monotone, 0).sum(axis=1)
+    # the positive half of the first pair which was left out
+    even = rho[params, 2 * kept]
+    tau += np.where((even > 0) | (pairs[params, kept] >= 0), even, 0)
+
+    n_samples = n_chains * n_draws
+    return n_samples / np.maximum(tau, 1 / np.log10(n_samples))
+
+
+def _convergence(series):
+    split = _split(series)
+    pooled = split.reshape(len(split), -1)
+    normalized = _rank_normalize(split)
+    median = np.median(pooled, axis=-1)[:, np.newaxis, np.newaxis]
+    rhat = np.maximum(_rhat(normalized),
+                      _rhat(_rank_normalize(np.abs(split - median))))
+
+    ess_bulk = _multi_chain_ess(normalized)
+    ess_tail = np.minimum(*[
+        _multi_chain_ess((split <= quantile[:, np.newaxis, np.newaxis])
+                         .astype(float))
+        for quantile in np.quantile(pooled, [0.05, 0.95], axis=-1)])
+    return np.stack([rhat, ess_bulk, ess_tail], axis=-1)
+
+
+def convergence(draws):
+    # draws is (chains x draws x parameters). Returns the rank normalized
+    # split R-hat, bulk ESS and tail ESS of each parameter as its columns.
+    draws = np.asarray(draws, dtype=float)
+    return _by_parameter(_convergence, draws)
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    # Largest-triangle-three-buckets: the rows of `y` (draws x parameters)
+    # to keep so each column, plotted against `x`, keeps its shape with only
+    # `n_out` points. Returns (n_out x parameters) row indices.
+    n, n_params = y.shape
+    if n <= n_out:
+        return np.broadcast_to(np.arange(n)[:, np.newaxis], (n, n_params))
+    # the first and last points are always kept, the rest are split into
+    # n_out - 2 buckets which each keep one point
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(int) + 1
+    edges[-1] = n - 1
+    # the mean of each bucket, with the last point standing in for the
+    # bucket after the last
+    x_sums = np.concatenate([[0], np.cumsum(x, dtype=float)])
+    y_sums = np.concatenate([np.zeros((1, n_params)),
+                             np.cumsum(y, axis=0, dtype=float)])
+    sizes = np.diff(edges)[:, np.newaxis]
+    x_means = np.append((x_sums[edges[1:]] - x_sums[edges[:-1]])
+                        / sizes[:, 0], x[-1])
+    y_means = np.concatenate([(y_sums[edges[1:]] - y_sums[edges[:-1]])
+                              / sizes, y[-1:]])
+
+    kept = np.empty((n_out, n_params), dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    columns = np.arange(n_params)
+    previous = np.zeros(n_params, dtype=np.int64)
+    # each bucket depends on the point kept from the one before
+    for bucket in range(n_out - 2):
+        begin, end = edges[bucket], edges[bucket + 1]
+        ax, ay = x[previous], y[previous, columns]
+        cx, cy = x_means[bucket + 1], y_means[bucket + 1]
+        area = np.abs((ax - cx) * (y[begin:end] - ay)
+                      - (ax - x[begin:end, np.newaxis]) * (cy - ay))
+        previous = begin + area.argmax(axis=0)
+        kept[bucket + 1] = previous
+    return kept
@@ -0,0 +1,222 @@
+import collections
+import concurrent.futures
+import functools
+import math
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+
+import numpy as np
+
+from q2_beast import _clade_index
+from q2_beast._annotation import annotate, node_table
+from q2_beast._nexus import (
+    copy_rows, index_trees, read_translate, read_tree, read_trees, select,
+    shard_trees, tip_bits, tree_shards)
+
+
+_LENGTHS_AND_COMMENTS = re.compile(r'\[[^\]]*\]|:[^,();\[]*')
+_CLADE_TOKEN = re.compile(r'[(),]|[^(),;\s]+')
+
+
+def clades(newick, bits):
+    # the taxa below every internal node of a tree, as bitsets
+    found = []
+    stack = []
+    for token in _CLADE_TOKEN.findall(_LENGTHS_AND_COMMENTS.sub('', newick)):
+        if token == '(':
+            stack.append(0)
+        elif token == ')':
+            clade = stack.pop()
+            found.append(clade)
+            if stack:
+                stack[-1] |= clade
+        elif token != ',' and stack:
+            stack[-1] |= bits[token]
+    return found
+
+
+def _count_shard(path, bits, begin, end, start, stride):
+    counts = collections.Counter()
+    n_trees = 0
+    for _, newick in shard_trees(path, begin, end, start, stride):
+        counts.update(clades(newick, bits))
+        n_trees += 1
+    return counts, n_trees
+
+
+def log_clade_credibility(tree_clades, counts, n_trees):
+    return (sum(math.log(counts[clade]) for clade in tree_clades)
+            - len(tree_clades) * math.log(n_trees))
+
+
+def _best(candidates):
+    # the first tree with the highest score wins ties, like treeannotator
+    best = None
+    for candidate in candidates:
+        if candidate is not None and (best is None
+                                      or candidate[0] > best[0]):
+            best = candidate
+    return best
+
+
+def _score_shard(counts, n_trees, path, bits, begin, end, start, stride):
+    return _best(
+        (log_clade_credibility(clades(newick, bits), counts, n_trees),
+         state, newick)
+        for state, newick in shard_trees(path, begin, end, start, stride))
+
+
+# the global clade counts, set before the worker processes are forked so
+# they inherit them, see _score_in_worker
+_worker_counts = None
+
+
+def _set_worker_counts(counts):
+    global _worker_counts
+    _worker_counts = counts
+
+
+def _score_in_worker(*shard):
+    return _score_shard(*_worker_counts, *shard)
+
+
+def write_mcc(out, header, newick, note=None):
+    with open(str(out), 'w') as fh:
+        fh.writelines(header)
+        if note is not None:
+            fh.write('[%s]\n' % note)
+        fh.write('tree TREE1 = [&R] %s\nEnd;\n' % newick)
+
+
+def _stream_mcc(path, bits, index, start, stride, n_jobs):
+    # Two streaming passes, counting clades then scoring every tree, so
+    # only the clade frequencies are ever held in memory. With `n_jobs`,
+    # each pass is split between processes by byte ranges of the file.
+    # A few shards per process evens out their share of the work.
+    shards = [(path, bits, begin, end, start, stride) for begin, end
+              in tree_shards(index, start, stride,
+                             n_jobs * 4 if n_jobs > 1 else 1)]
+    if not shards:
+        raise ValueError("There are no trees after the burn-in.")
+
+    if n_jobs == 1:
+        counts, n_trees = _count_shard(*shards[0])
+        best = _score_shard(counts, n_trees, *shards[0])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            counted = list(pool.map(_count_shard, *zip(*shards)))
+        counts = collections.Counter()
+        n_trees = 0
+        for shard_counts, shard_n_trees in counted:
+            counts.update(shard_counts)
+            n_trees += shard_n_trees
+        del counted
+        # Forked workers inherit the counts rather than having them pickled
+        # for every shard, other start methods have to be sent them.
+        if multiprocessing.get_start_method() == 'fork':
+            _set_worker_counts((counts, n_trees))
+            score = _score_in_worker
+        else:
+            score = functools.partial(_score_shard, counts, n_trees)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+                best = _best(pool.map(score, *zip(*shards)))
+        finally:
+            _set_worker_counts(None)
+
+    _, _, newick = best
+    return counts, n_trees, newick
+
+
+def _indexed_mcc(path, bits, index, start, stride, clade_index,
+                 states=None):
+    # the same tree from a clade index, without reading any but that tree,
+    # `states` restricts it to a sample of the trees
+    selected = _clade_index.selected_trees(clade_index, start, stride)
+    if states is not None:
+        selected &= np.isin(clade_index['states'], states)
+    n_trees = int(selected.sum())
+    if not n_trees:
+        raise ValueError("There are no trees after the burn-in.")
+    counts = _clade_index.clade_counts(clade_index, selected)
+    tree = _clade_index.best_tree(clade_index, counts, selected)
+    newick = read_tree(path, index, int(clade_index['states'][tree]))
+    counts, samples = _clade_index.clade_samples(
+        clade_index, counts, selected, tree, node_table(newick, bits).clades)
+    return counts, n_trees, newick, samples
+
+
+def frequency_error(n_sampled, n_trees, alpha=0.05):
+    # Hoeffding-Serfling bound on how far a clade's frequency in a sample
+    # drawn without replacement is from its frequency in all of the trees,
+    # with probability 1 - alpha. It holds for any one clade fixed before
+    # sampling, not for all the clades the sample happens to contain.
+    return math.sqrt(math.log(2 / alpha)
+                     * (1 - (n_sampled - 1) / n_trees) / (2 * n_sampled))
+
+
+def _summarize(path, out, index, start, stride, n_jobs, heights,
+               clade_index, states=None, sample=None):
+    # A last pass collects the heights and rates of the chosen tree's
+    # clades, unless they are already in `clade_index`. `sample` is the
+    # (number of trees, seed) the trees were subsampled with, if they were.
+    with open(str(path)) as fh:
+        header, translate = read_translate(fh)
+    bits = tip_bits(translate)
+
+    samples = None
+    if clade_index is None:
+        counts, n_trees, newick = _stream_mcc(path, bits, index, start,
+                                              stride, n_jobs)
+    else:
+        counts, n_trees, newick, samples = _indexed_mcc(
+            path, bits, index, start, stride, clade_index, states)
+
+    note = None
+    if sample is not None:
+        n_total, seed = sample
+        note = ('Approximate MCC tree from %d of %d trees (seed %d), each'
+                ' clade\'s frequency in the sample is within %.4f of its'
+                ' frequency in all the trees with 95%% probability'
+                % (n_trees, n_total, seed,
+                   frequency_error(n_trees, n_total)))
+
+    sampled = None if states is None else set(states.tolist())
+    trees = (tree for state, tree in read_trees(path, start=start,
+                                                stride=stride, index=index)
+             if sampled is None or state in sampled)
+    write_mcc(out, header, annotate(newick, trees, bits, counts, n_trees,
+                                    heights=heights, samples=samples),
+              note=note)
+
+
+def maximum_clade_credibility(path, out, start=0, stride=1, index=None,
+                              n_jobs=1, heights='keep', clade_index=None,
+                              max_trees=None, seed=None):
+    if index is None:
+        index = index_trees(path)
+    rows = select(index, start, stride=stride)
+    if max_trees is None or len(rows) <= max_trees:
+        _summarize(path, out, index, start, stride, n_jobs, heights,
+                   clade_index)
+        return
+
+    # A uniform sample without replacement. The index already knows where
+    # every tree is, so only the sampled trees are ever read.
+    if seed is None:
+        seed = random.randrange(1, 2**31)
+    n_trees = len(rows)
+    rows = rows[sorted(random.Random(seed).sample(range(n_trees),
+                                                  max_trees))]
+    if clade_index is not None:
+        _summarize(path, out, index, start, stride, n_jobs, heights,
+                   clade_index, states=rows[:, 0], sample=(n_trees, seed))
+        return
+    with tempfile.TemporaryDirectory(prefix='q2-beast-mcc-') as tmp:
+        sample = os.path.join(tmp, 'sample.trees')
+        copy_rows(path, index, rows, sample)
+        _summarize(sample, out, index_trees(sample), 0, 1, n_jobs, heights,
+                   None, sample=(n_trees, seed))
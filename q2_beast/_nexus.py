@@ -0,0 +1,397 @@
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+
+_TREE_STATE = re.compile(r'^\s*tree\s+STATE_(\d+)', re.IGNORECASE)
+_TREE = re.compile(r'^\s*tree\s+STATE_(\d+)\s*(?:\[[^\]]*\]\s*)?='
+                   r'\s*(?:\[&[RU]\]\s*)?(.*;)', re.IGNORECASE)
+_TREE_STATE_BYTES = re.compile(rb'^\s*tree\s+STATE_(\d+)', re.IGNORECASE)
+_NEWICK_TOKEN = re.compile(r'[(),;]|:[^,();\[]*|\[[^\]]*\]|[^,():;\[\]\s]+')
+
+
+def tree_state(line):
+    match = _TREE_STATE.match(line)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def in_sample(state, start=0, stop=None, stride=1):
+    # `stride` keeps the same states as logcombiner's -resample
+    return (state >= start and (stop is None or state < stop)
+            and state % stride == 0)
+
+
+def output_interval(interval, resample=None):
+    # spacing of the renumbered states, the same for logs and trees, no
+    # resampling (None or 0) keeps every sample as in_sample does
+    return (interval if not resample
+            else int(np.lcm(interval, resample)))
+
+
+def tip_bits(translate):
+    # each taxon of the translate table is one bit of a clade
+    if not translate:
+        raise ValueError("The trees do not have a translate table.")
+    return {number: 1 << bit for bit, number in enumerate(translate)}
+
+
+def read_translate(fh):
+    # Read the header of an open Nexus file up to the first tree, leaving
+    # `fh` positioned there. Returns the header lines and the translate
+    # table of tip numbers to taxa.
+    header = []
+    translate = {}
+    in_translate = False
+    while True:
+        position = fh.tell()
+        line = fh.readline()
+        if not line or tree_state(line) is not None:
+            fh.seek(position)
+            return header, translate
+        header.append(line)
+        stripped = line.strip()
+        if stripped.lower() == 'translate':
+            in_translate = True
+        elif in_translate:
+            for entry in stripped.rstrip(';').split(','):
+                if entry.strip():
+                    number, taxon = entry.split(None, 1)
+                    translate[number] = taxon.strip().strip('\'"')
+            if stripped.endswith(';'):
+                in_translate = False
+
+
+class Node:
+    __slots__ = ('name', 'length', 'comment', 'children')
+
+    def __init__(self):
+        self.name = None
+        self.length = 0.0
+        self.comment = None
+        self.children = []
+
+    def postorder(self):
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited or not node.children:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in reversed(node.children))
+
+
+def newick_tokens(newick):
+    return _NEWICK_TOKEN.findall(newick)
+
+
+def parse_newick(newick, translate=None):
+    root = node = Node()
+    stack = []
+    for token in newick_tokens(newick):
+        if token == '(':
+            child = Node()
+            node.children.append(child)
+            stack.append(node)
+            node = child
+        elif token == ',':
+            child = Node()
+            stack[-1].children.append(child)
+            node = child
+        elif token == ')':
+            node = stack.pop()
+        elif token == ';':
+            break
+        elif token[0] == ':':
+            node.length = float(token[1:])
+        elif token[0] == '[':
+            node.comment = token[1:-1]
+        else:
+            node.name = token if translate is None else translate[token]
+    return root
+
+
+def iter_trees(fh, start=0, stop=None, stride=1, translate=None):
+    # Yields (state, newick) for the sampled trees of an open Nexus file,
+    # one line at a time. With a translate table the trees are parsed.
+    for line in fh:
+        match = _TREE.match(line)
+        if match is None:
+            continue
+        state = int(match.group(1))
+        if stop is not None and state >= stop:
+            break
+        if not in_sample(state, start, stop, stride):
+            continue
+        newick = match.group(2)
+        if translate is not None:
+            yield state, parse_newick(newick, translate)
+        else:
+            yield state, newick
+
+
+def _label(node, root=False):
+    label = node.name or ''
+    if node.comment is not None:
+        label += '[%s]' % node.comment
+    if not root:
+        label += ':%r' % node.length
+    return label
+
+
+def format_newick(root):
+    # iterative, as deep (caterpillar-like) trees would overflow the stack
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            out.append(node)
+        elif node.children:
+            stack.append(_label(node, root=node is root))
+            stack.append(')')
+            for position, child in enumerate(reversed(node.children)):
+                if position:
+                    stack.append(',')
+                stack.append(child)
+            out.append('(')
+        else:
+            out.append(_label(node, root=node is root))
+    return ''.join(out) + ';'
+
+
+def seek_state(fh, index, state):
+    # position an open Nexus file at its first tree from `state` onwards,
+    # Nexus is ASCII so the byte offsets are valid text positions
+    first = np.searchsorted(index[:, 0], state)
+    if first < len(index):
+        fh.seek(int(index[first, 1]))
+    else:
+        fh.seek(0, os.SEEK_END)
+
+
+def read_trees(path, start=0, stop=None, stride=1, parse=False, index=None):
+    with open(str(path)) as fh:
+        _, translate = read_translate(fh)
+        if index is not None:
+            seek_state(fh, index, start)
+        yield from iter_trees(fh, start=start, stop=stop, stride=stride,
+                              translate=translate if parse else None)
+
+
+def index_trees(path, offset=0):
+    # (state, byte offset, byte length) of every tree line after `offset`
+    rows = []
+    with open(str(path), 'rb') as fh:
+        fh.seek(offset)
+        for line in fh:
+            match = _TREE_STATE_BYTES.match(line)
+            if match is not None and line.endswith(b'\n'):
+                rows.append((int(match.group(1)), offset, len(line)))
+            offset += len(line)
+    return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+
+def _end(index):
+    return int(index[-1, 1] + index[-1, 2]) if len(index) else 0
+
+
+def write_trees_index(trees_path, index_path, previous=None):
+    # `previous` indexes the start of the file, only the rest is scanned
+    if previous is None or not len(previous):
+        index = index_trees(trees_path)
+    else:
+        index = np.concatenate([previous,
+                                index_trees(trees_path, _end(previous))])
+    partial = str(index_path) + '.partial.npy'
+    np.save(partial, index)
+    os.replace(partial, str(index_path))
+
+
+def load_trees_index(chain):
+    index_path = chain.trees_index.path_maker()
+    if index_path.exists():
+        return np.load(str(index_path))
+    return index_trees(chain.trees.path_maker())
+
+
+def select(index, start=0, stop=None, stride=1):
+    states = index[:, 0]
+    mask = (states >= start) & (states % stride == 0)
+    if stop is not None:
+        mask &= states < stop
+    return index[mask]
+
+
+def _byte_ranges(selected):
+    # merge adjacent tree lines so they can be copied in one go
+    if not len(selected):
+        return
+    ends = selected[:, 1] + selected[:, 2]
+    breaks = np.flatnonzero(selected[1:, 1] != ends[:-1]) + 1
+    for run in np.split(np.arange(len(selected)), breaks):
+        yield selected[run[0], 1], ends[run[-1]]
+
+
+def copy_rows(path, index, rows, out):
+    # Write a Nexus file of the trees at `rows` of the index without parsing
+    # any of them, by copying their byte ranges.
+    with open(str(path), 'rb') as fh:
+        if not len(index):
+            with open(str(out), 'wb') as out_fh:
+                shutil.copyfileobj(fh, out_fh)
+            return
+        with open(str(out), 'wb') as out_fh:
+            out_fh.write(fh.read(int(index[0, 1])))
+            for begin, end in _byte_ranges(rows):
+                fh.seek(int(begin))
+                remaining = int(end - begin)
+                while remaining:
+                    chunk = fh.read(min(remaining, 1 << 20))
+                    out_fh.write(chunk)
+                    remaining -= len(chunk)
+            out_fh.write(b'End;\n')
+
+
+def copy_trees(path, index, out, start=0, stop=None, stride=1):
+    copy_rows(path, index, select(index, start, stop, stride), out)
+
+
+def read_tree(path, index, state):
+    row = np.searchsorted(index[:, 0], state)
+    if row == len(index) or index[row, 0] != state:
+        raise KeyError(state)
+    with open(str(path), 'rb') as fh:
+        fh.seek(int(index[row, 1]))
+        line = fh.read(int(index[row, 2])).decode()
+    return _TREE.match(line).group(2)
+
+
+def tree_interval(path):
+    with open(str(path)) as fh:
+        states = []
+        for line in fh:
+            state = tree_state(line)
+            if state is not None:
+                states.append(state)
+                if len(states) == 2:
+                    return states[1] - states[0]
+    return 1
+
+
+def combine_trees(paths, out, burn_in, resample=None, indexes=None,
+                  out_index=None, pool=None):
+    # Streaming counterpart of combine_logs: each file is read once, with an
+    # index the burn-in is skipped by seeking, and every kept tree line is
+    # written with its state renumbered. With `out_index`, `out` is already
+    # a combined file (with that index) and the trees are appended to it.
+    # With a `pool` (an Executor) the files are filtered concurrently.
+    if indexes is None:
+        indexes = [None] * len(paths)
+    translate = None
+    state = 0
+    if out_index is None:
+        step = output_interval(tree_interval(paths[0]), resample)
+    else:
+        if not len(out_index):
+            raise ValueError("%s has no trees to append to." % out)
+        step = (int(out_index[-1, 0] - out_index[-2, 0])
+                if len(out_index) > 1
+                else output_interval(tree_interval(paths[0]), resample))
+        state = int(out_index[-1, 0]) + step
+        with open(str(out)) as fh:
+            _, translate = read_translate(fh)
+        os.truncate(str(out), _end(out_index))  # drop the closing End;
+    with open(str(out), 'w' if out_index is None else 'a') as out_fh:
+        for path, start, index in zip(paths, burn_in, indexes):
+            with open(str(path)) as fh:
+                header, file_translate = read_translate(fh)
+                if translate is None:
+                    translate = file_translate
+                    out_fh.writelines(header)
+                elif file_translate != translate:
+                    raise ValueError("%s does not translate the same taxa as"
+                                     " the other trees." % path)
+                if pool is None:
+                    if index is not None:
+                        seek_state(fh, index, start)
+                    state = _write_trees(fh, out_fh, start, resample, state,
+                                         step)
+        if pool is not None:
+            indexes = [index_trees(path) if index is None else index
+                       for path, index in zip(paths, indexes)]
+            counts = [len(select(index, start, stride=resample or 1))
+                      for index, start in zip(indexes, burn_in)]
+            combine_parts(pool, out_fh, _tree_part,
+                          [(path, index, start, resample, step)
+                           for path, index, start
+                           in zip(paths, indexes, burn_in)],
+                          counts, state, step)
+        out_fh.write('End;\n')
+
+
+def _write_trees(lines, out_fh, start, resample, state, step):
+    # the sampled tree lines renumbered from `state`, returns the next state
+    for line in lines:
+        match = _TREE_STATE.match(line)
+        if match is None or not line.endswith('\n'):
+            continue
+        if not in_sample(int(match.group(1)), start, stride=resample or 1):
+            continue
+        out_fh.write('%s%d%s' % (line[:match.start(1)], state,
+                                 line[match.end(1):]))
+        state += step
+    return state
+
+
+def _tree_part(part, state, path, index, start, resample, step):
+    with open(str(path)) as fh, open(part, 'w') as out_fh:
+        seek_state(fh, index, start)
+        _write_trees(fh, out_fh, start, resample, state, step)
+
+
+def combine_parts(pool, out_fh, write_part, args, counts, state, step):
+    # Every file is filtered at once by `write_part(part, state, *args)` in
+    # `pool`, each into its own part numbered on from the `counts` samples
+    # kept from the files before it, then the parts are copied to `out_fh`
+    # in order. Returns the state after the last sample.
+    firsts = state + step * np.concatenate([[0], np.cumsum(counts)[:-1]])
+    with tempfile.TemporaryDirectory(prefix='q2-beast-parts-') as tmp:
+        parts = [os.path.join(tmp, str(i)) for i in range(len(args))]
+        jobs = [pool.submit(write_part, part, int(first), *part_args)
+                for part, first, part_args in zip(parts, firsts, args)]
+        for job in jobs:
+            job.result()
+        for part in parts:
+            with open(part) as fh:
+                shutil.copyfileobj(fh, out_fh)
+    return state + step * int(sum(counts))
+
+
+def tree_shards(index, start, stride, n_shards):
+    # contiguous byte ranges of the sampled trees, split at tree boundaries
+    selected = select(index, start, stride=stride)
+    return [(int(rows[0, 1]), int(rows[-1, 1] + rows[-1, 2]))
+            for rows in np.array_split(selected, n_shards) if len(rows)]
+
+
+def _read_range(fh, begin, end):
+    fh.seek(begin)
+    position = begin
+    for line in fh:
+        if position >= end:
+            return
+        position += len(line)
+        yield line.decode()
+
+
+def shard_trees(path, begin, end, start, stride):
+    with open(str(path), 'rb') as fh:
+        yield from iter_trees(_read_range(fh, begin, end), start=start,
+                              stride=stride)
@@ -0,0 +1,246 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from q2_beast._nexus import combine_parts, in_sample, output_interval
+
+_CHUNK_SIZE = 100000
+
+
+def log_header(path):
+    # BEAST starts the log with # comments, then a tab separated header
+    with open(str(path)) as fh:
+        for lineno, line in enumerate(fh):
+            if line.startswith('#') or not line.strip():
+                continue
+            return lineno, line.rstrip('\n').split('\t')
+    raise ValueError("%s does not have a header." % path)
+
+
+def _data_lines(fh):
+    for line in fh:
+        if line.startswith('#') or not line.strip():
+            continue
+        yield line
+
+
+def sample_interval(path):
+    # the number of states between samples, from the first two samples
+    with open(str(path)) as fh:
+        lines = _data_lines(fh)
+        next(lines, None)  # header
+        states = [int(line.split('\t', 1)[0])
+                  for _, line in zip(range(2), lines)]
+    return states[1] - states[0] if len(states) == 2 else 1
+
+
+def last_line(path, block=1 << 16):
+    # read backwards from the end, so only the tail of a large file is read
+    with open(str(path), 'rb') as fh:
+        end = fh.seek(0, os.SEEK_END)
+        data = b''
+        while end > 0:
+            start = max(0, end - block)
+            fh.seek(start)
+            data = fh.read(end - start) + data
+            lines = data.rstrip().rsplit(b'\n', 1)
+            if len(lines) == 2 or start == 0:
+                return lines[-1].decode()
+            end = start
+    return ''
+
+
+def _write_samples(lines, out_fh, start, resample, state, step):
+    # the sampled lines renumbered from `state`, returns the next state
+    for line in lines:
+        original, rest = line.split('\t', 1)
+        if not in_sample(int(original), start, stride=resample or 1):
+            continue
+        out_fh.write('%d\t%s' % (state, rest))
+        state += step
+    return state
+
+
+def _samples(fh):
+    lines = _data_lines(fh)
+    next(lines, None)  # header
+    return lines
+
+
+def _count_samples(path, start, resample):
+    with open(str(path)) as fh:
+        return sum(in_sample(int(line.split('\t', 1)[0]), start,
+                             stride=resample or 1) for line in _samples(fh))
+
+
+def _log_part(part, state, path, start, resample, step):
+    with open(str(path)) as fh, open(part, 'w') as out_fh:
+        _write_samples(_samples(fh), out_fh, start, resample, state, step)
+
+
+def combine_logs(paths, out, burn_in, resample=None, append=False,
+                 pool=None):
+    # Concatenate logs one line at a time, dropping the states before each
+    # log's `burn_in` and keeping those which are multiples of `resample`.
+    # States are renumbered from 0 like logcombiner does and every other
+    # value is copied through untouched. With `append`, `out` is already a
+    # combined log and the samples continue on from its last state. With a
+    # `pool` (an Executor) the logs are counted and then filtered
+    # concurrently, so each knows the state its samples are numbered from.
+    if append:
+        _, header = log_header(out)
+        step = sample_interval(out)
+        last = last_line(out).split('\t', 1)[0]
+        state = int(last) + step if last.isdigit() else 0
+    else:
+        header = None
+        step = output_interval(sample_interval(paths[0]), resample)
+        state = 0
+    with open(str(out), 'a' if append else 'w') as out_fh:
+        for path, start in zip(paths, burn_in):
+            with open(str(path)) as fh:
+                for line in fh:
+                    if line.startswith('#') or not line.strip():
+                        if header is None:
+                            out_fh.write(line)
+                        continue
+                    columns = line.rstrip('\n').split('\t')
+                    if header is None:
+                        header = columns
+                        out_fh.write(line)
+                    elif header != columns:
+                        raise ValueError("%s does not have the same columns"
+                                         " as the other logs." % path)
+                    break
+                if pool is None:
+                    state = _write_samples(_data_lines(fh), out_fh, start,
+                                           resample, state, step)
+        if pool is not None:
+            counts = list(pool.map(_count_samples, paths, burn_in,
+                                   [resample] * len(paths)))
+            combine_parts(pool, out_fh, _log_part,
+                          [(path, start, resample, step)
+                           for path, start in zip(paths, burn_in)],
+                          counts, state, step)
+
+
+def read_posterior_log(path, columns=None, dtype=None, stride=1):
+    # Only the requested columns are converted, every `stride`-th sample is
+    # kept, and `dtype` (e.g. np.float32) applies to everything but `state`.
+    header_lineno, header = log_header(path)
+    if columns is None:
+        columns = header
+    columns = list(dict.fromkeys(columns))
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError("%r are not columns of the posterior log."
+                         % missing)
+
+    dtypes = None
+    if dtype is not None:
+        dtypes = {c: np.int64 if c == 'state' else dtype for c in columns}
+
+    def skip(lineno):
+        if lineno < header_lineno:
+            return True
+        return lineno > header_lineno and (lineno - header_lineno - 1) % stride
+
+    df = pd.read_csv(str(path), sep='\t', skip_blank_lines=True,
+                     skiprows=skip, usecols=columns, dtype=dtypes)
+    return df[columns]
+
+
+def write_log_columns(log_path, columns_path, previous=None, offset=0):
+    # A columnar copy of the log which can be memory mapped: a Fortran
+    # ordered (samples x columns) float64 .npy, so each column of the log is
+    # contiguous. The columns are those of the log's header, states are
+    # exact as floats up to 2**53.
+    # With `previous`, the columns of the log before byte `offset` are
+    # copied from that earlier copy and only the rest of the log is parsed.
+    header_lineno, header = log_header(log_path)
+    n_previous = 0
+    if previous is not None:
+        previous = np.load(str(previous), mmap_mode='r')
+        if previous.ndim != 2 or previous.shape[1] != len(header):
+            raise ValueError("%s does not have the same columns as its"
+                             " earlier copy." % log_path)
+        n_previous = len(previous)
+
+    with open(str(log_path)) as fh:
+        if previous is None:
+            for _ in range(header_lineno + 1):
+                fh.readline()
+        else:
+            fh.seek(offset)
+        start = fh.tell()
+        n_samples = n_previous + sum(1 for line in fh if line.strip())
+
+        partial = str(columns_path) + '.partial'
+        columns = np.lib.format.open_memmap(
+            partial, mode='w+', dtype=np.float64,
+            shape=(n_samples, len(header)), fortran_order=True)
+        if previous is not None:
+            for column in range(len(header)):
+                columns[:n_previous, column] = previous[:, column]
+
+        fh.seek(start)
+        row = n_previous
+        for chunk in pd.read_csv(fh, sep='\t', header=None, names=header,
+                                 skip_blank_lines=True,
+                                 chunksize=_CHUNK_SIZE):
+            end = row + len(chunk)
+            for column, name in enumerate(header):
+                columns[row:end, column] = chunk[name].to_numpy()
+            row = end
+    columns.flush()
+    del columns, previous
+    os.replace(partial, str(columns_path))
+
+
+def read_log_columns(path, header, columns=None, dtype=None, stride=1):
+    # same as `read_posterior_log`, but from `write_log_columns` of a log
+    # with `header`, only the pages of the requested columns are ever read
+    data = np.load(str(path), mmap_mode='r')
+    if data.ndim != 2 or data.shape[1] != len(header):
+        raise ValueError("%s does not have the columns of its posterior log."
+                         % path)
+    if columns is None:
+        columns = header
+    columns = list(dict.fromkeys(columns))
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError("%r are not columns of the posterior log."
+                         % missing)
+
+    values = {}
+    for column in columns:
+        series = data[::stride, header.index(column)]
+        if column == 'state':
+            series = series.astype(np.int64)
+        elif dtype is not None:
+            series = series.astype(dtype)
+        values[column] = series
+    return pd.DataFrame(values, columns=columns)
+
+
+def read_chain_log(chain, columns=None, dtype=None, stride=1):
+    # prefer the columnar copy of a chain's log when it has one
+    columns_path = chain.log_columns.path_maker()
+    log_path = chain.log.path_maker()
+    if columns_path.exists():
+        _, header = log_header(log_path)
+        return read_log_columns(columns_path, header, columns=columns,
+                                dtype=dtype, stride=stride)
+    return read_posterior_log(log_path, columns=columns, dtype=dtype,
+                              stride=stride)
+
+
+def read_run_info(chain):
+    # merged chains and those from older versions have none
+    run_info_path = chain.run_info.path_maker()
+    if not run_info_path.exists():
+        return {}
+    with run_info_path.open() as fh:
+        return json.load(fh)
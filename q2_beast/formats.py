@@ -6,11 +6,21 @@ class PosteriorLogFormat(model.TextFileFormat):
         pass
 
 
+class PosteriorLogColumnsFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        pass
+
+
 class NexusFormat(model.TextFileFormat):
     def _validate_(self, level):
         pass
 
 
+class NexusIndexFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        pass
+
+
 class BEASTControlFileFormat(model.TextFileFormat):
     def _validate_(self, level):
         pass
@@ -25,13 +35,50 @@ class BEASTOpsFileFormat(model.TextFileFormat):
         pass
 
 
+class BEASTStateFileFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        pass
+
+
+class BEASTRunInfoFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        pass
+
+
 class BEASTPosteriorDirFmt(model.DirectoryFormat):
     log = model.File('posterior.log', format=PosteriorLogFormat)
     trees = model.File('posterior.trees', format=NexusFormat)
-    ops = model.File('posterior.ops', format=BEASTOpsFileFormat)
+    # BEAST only writes the operator analysis once the chain is complete
+    ops = model.File('posterior.ops', format=BEASTOpsFileFormat,
+                     optional=True)
     control = model.File('control_file.xml',
                          format=BEASTControlFileFormat)
+    checkpoint = model.File('posterior.state', format=BEASTStateFileFormat,
+                            optional=True)
+    run_info = model.File('run_info.json', format=BEASTRunInfoFormat,
+                          optional=True)
+    # columnar copy of the log, see q2_beast._posterior_log
+    log_columns = model.File('posterior.log.npy',
+                             format=PosteriorLogColumnsFormat, optional=True)
+    # byte offset of every tree, see q2_beast._nexus
+    trees_index = model.File('posterior.trees.npy', format=NexusIndexFormat,
+                             optional=True)
 
 
 NexusDirFmt = model.SingleFileDirectoryFormat(
     'NexusDirFmt', 'data.nex', format=NexusFormat)
+
+
+class CladeIndexFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        pass
+
+
+class CladeIndexDirFmt(model.DirectoryFormat):
+    # see q2_beast._clade_index
+    clades = model.File('clades.npy', format=CladeIndexFormat)
+    states = model.File('states.npy', format=CladeIndexFormat)
+    offsets = model.File('offsets.npy', format=CladeIndexFormat)
+    members = model.File('members.npy', format=CladeIndexFormat)
+    heights = model.File('heights.npy', format=CladeIndexFormat)
+    rates = model.File('rates.npy', format=CladeIndexFormat)
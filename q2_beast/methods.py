@@ -1,61 +1,370 @@
-import pkg_resources
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import random
+import shutil
+import signal
 import subprocess
+import threading
+import time
 
-import jinja2
-import pandas as pd
+import numpy as np
 
 import qiime2
 
-from q2_beast.formats import (BEASTPosteriorDirFmt, NexusFormat,
-                              PosteriorLogFormat)
+from q2_beast.formats import (BEASTPosteriorDirFmt, CladeIndexDirFmt,
+                              NexusFormat, PosteriorLogFormat)
+from q2_beast import _clade_index, _mcc
+from q2_beast._alignment import count_patterns, decode, preprocess
+from q2_beast._beagle import (PILOT_GENERATIONS, allocate_threads,
+                              beagle_flags, cache_key, tune)
+from q2_beast._cache import cache_dir
+from q2_beast._diagnostics import effective_sample_size
+from q2_beast._nexus import (
+    combine_trees, copy_trees, load_trees_index, read_translate, tip_bits,
+    tree_state, write_trees_index)
+from q2_beast._posterior_log import (
+    combine_logs, read_run_info, write_log_columns)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_environment():
+    # One environment per process, so each template is only parsed once.
+    # Compiled templates are also kept on disk for the next process.
+    import jinja2  # only needed once an action runs, not to load the plugin
+
+    # the package is not zip safe, so its templates are always on disk
+    path = os.path.join(os.path.dirname(__file__), 'xml-templates')
+    loader = jinja2.FileSystemLoader(searchpath=path)
+    bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir('jinja2'))
+    return jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
 
 
 def _get_template(name):
-    path = pkg_resources.resource_filename('q2_beast',
-                                           'xml-templates')
-    loader = jinja2.FileSystemLoader(searchpath=path)
-    env = jinja2.Environment(loader=loader)
-    return env.get_template(name)
-
+    return _get_environment().get_template(name)
 
-def gtr_single_partition(
-        alignment: qiime2.Metadata,
-        time: qiime2.NumericMetadataColumn,
-        n_generations: int,
-        sample_every: int,
-        time_uncertainty: qiime2.NumericMetadataColumn = None,
-        base_freq: str = "estimated",
-        site_gamma: int = 4,
-        site_invariant: bool = True,
-        clock: str = 'ucln',
-        coalescent_model: str = 'skygrid',
-        skygrid_intervals: int = None,
-        skygrid_duration: float = None,
-        print_every: int = None,
-        use_gpu: bool = False,
-        n_threads: int = 1) -> BEASTPosteriorDirFmt:
 
-    if coalescent_model == 'skygrid':
-        if skygrid_duration is None or skygrid_intervals is None:
-            raise ValueError("skygrid not parameterized (TODO: better error)")
-
-    # Parallelization options
+def _beast_call(use_gpu, n_threads, seed=None, beagle=None):
     beast_call = ['beast']
+    if seed is not None:
+        beast_call += ['-seed', str(seed)]
     if use_gpu:
         if n_threads != 1:
             raise ValueError
         beast_call += ['-beagle_GPU', '-beagle_cuda', '-beagle_instances', '1']
+    elif beagle is not None:
+        beast_call += beagle_flags(beagle)
     else:
         beast_call += ['-beagle_CPU', '-beagle_SSE',
                        '-beagle_instances', str(n_threads)]
+    return beast_call
 
-    # Set up directory format where BEAST will write everything
-    result = BEASTPosteriorDirFmt()
-    control_file = str(result.control.path_maker())
 
+def _tune_beagle(template_name, template_kwargs, n_taxa, n_patterns,
+                 use_gpu, n_threads):
+    if use_gpu:
+        raise ValueError("BEAGLE can only be tuned for CPU instances.")
+    key = cache_key(template_name, n_taxa, n_patterns, n_threads)
+
+    pilot_kwargs = dict(template_kwargs, n_generations=PILOT_GENERATIONS,
+                        sample_every=PILOT_GENERATIONS,
+                        print_every=PILOT_GENERATIONS)
+    template = _get_template(template_name)
+
+    def render(control_file):
+        template.stream(**pilot_kwargs).dump(control_file)
+
+    return tune(render, n_threads, key)
+
+
+def _checkpoint_call(result, checkpoint_every):
+    if checkpoint_every is None:
+        return []
+    state_file = str(result.checkpoint.path_maker().relative_to(result.path))
+    return ['-save_every', str(checkpoint_every), '-save_state', state_file]
+
+
+def _output_files(result):
+    # relative to the directory format, so they are the same for every chain
     ops_file = str(result.ops.path_maker().relative_to(result.path))
     log_file = str(result.log.path_maker().relative_to(result.path))
     trees_file = str(result.trees.path_maker().relative_to(result.path))
+    return dict(trees_file=trees_file, ops_file=ops_file, log_file=log_file)
+
+
+def _complete_lines(path):
+    # a chain which was interrupted may end on a partially written line
+    with open(str(path)) as fh:
+        for line in fh:
+            if line.endswith('\n'):
+                yield line
+
+
+def _log_row_state(line):
+    if line.startswith('#') or not line.strip():
+        return None
+    try:
+        return int(line.split('\t', 1)[0])
+    except ValueError:
+        return None  # header
+
+
+# Columns every BEAST control file in this plugin logs
+_ESS_COLUMNS = ['joint', 'prior', 'likelihood']
+_ESS_POLL_SECONDS = 30
+# how quickly a chain is stopped once another chain has failed
+_CANCEL_POLL_SECONDS = 1
+_ESS_MIN_SAMPLES = 100
+_ESS_BURN_IN = 0.1  # same default as Tracer
+
+
+class _LogTail:
+    # Incrementally reads the samples of a posterior.log which BEAST is
+    # still writing to.
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self._offset = 0
+        self._indices = None
+        self.states = []
+        self.rows = []
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as fh:
+            fh.seek(self._offset)
+            while True:
+                line = fh.readline()
+                if not line.endswith('\n'):
+                    break  # not finished being written yet
+                self._offset = fh.tell()
+                self._parse(line)
+
+    def _parse(self, line):
+        if line.startswith('#') or not line.strip():
+            return
+        fields = line.rstrip('\n').split('\t')
+        if self._indices is None:
+            missing = set(self.columns) - set(fields)
+            if missing:
+                raise ValueError("Cannot track the ESS of %r as these are not"
+                                 " columns of the posterior log."
+                                 % sorted(missing))
+            self._indices = [fields.index(c) for c in self.columns]
+            return
+        self.states.append(int(fields[0]))
+        self.rows.append([float(fields[i]) for i in self._indices])
+
+    def ess(self):
+        samples = np.asarray(self.rows)
+        samples = samples[int(len(samples) * _ESS_BURN_IN):]
+        return effective_sample_size(samples)
+
+
+def _without_footer(lines, footer):
+    # Every line but a `footer` which ends the file (followed by nothing but
+    # blank lines), such as the Nexus End; after the trees. Any other line
+    # like it, such as the End; of a taxa block, is kept.
+    held = []
+    for line in lines:
+        if line.strip().lower() == footer.lower():
+            yield from held
+            held = [line]
+        elif held and not line.strip():
+            held.append(line)
+        else:
+            yield from held
+            held = []
+            yield line
+
+
+def _truncate(path, get_state, last_state, footer=''):
+    truncated = str(path) + '.truncated'
+    lines = _complete_lines(path)
+    if footer:
+        lines = _without_footer(lines, footer)
+    with open(truncated, 'w') as fh:
+        for line in lines:
+            state = get_state(line)
+            if state is None:
+                fh.write(line)
+            elif state <= last_state:
+                fh.write(line)
+        if footer:
+            fh.write(footer + '\n')
+    os.replace(truncated, str(path))
+
+
+def _truncate_chain(result, last_state):
+    # the trees may lag behind the log when BEAST is stopped
+    tree_states = [tree_state(line)
+                   for line in _complete_lines(result.trees.path_maker())]
+    last_state = max([s for s in tree_states
+                      if s is not None and s <= last_state], default=0)
+    _truncate(result.log.path_maker(), _log_row_state, last_state)
+    _truncate(result.trees.path_maker(), tree_state, last_state,
+              footer='End;')
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _wait_process(process, timeout, cancel=None):
+    # True once `process` has exited, False after `timeout` seconds. Raises
+    # _Cancelled as soon as `cancel` (a threading.Event) is set.
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = max(deadline - time.monotonic(), 0)
+        try:
+            process.wait(timeout=remaining if cancel is None
+                         else min(remaining, _CANCEL_POLL_SECONDS))
+            return True
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.is_set():
+                raise _Cancelled()
+            if time.monotonic() >= deadline:
+                return False
+
+
+def _run_until_converged(beast_call, result, target_ess, ess_params,
+                         cancel=None):
+    tail = None
+    if target_ess is not None:
+        tail = _LogTail(str(result.log.path_maker()),
+                        _ESS_COLUMNS + list(ess_params or []))
+    # BEAST is a wrapper script around the JVM, so signal the whole group
+    process = subprocess.Popen(beast_call, cwd=result.path,
+                               start_new_session=True)
+    try:
+        while True:
+            if _wait_process(process, _ESS_POLL_SECONDS, cancel):
+                break  # reached n_generations
+            if tail is None:
+                continue
+            tail.read()
+            if len(tail.rows) < _ESS_MIN_SAMPLES:
+                continue
+            # constant columns have no ESS, so they can't hold things up
+            if not (tail.ess() < target_ess).any():
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+                _truncate_chain(result, tail.states[-1])
+                return
+    except BaseException:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, beast_call)
+
+
+def _wait(jobs):
+    for job in jobs:
+        job.result()
+
+
+def _write_sidecars(result):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        _wait([pool.submit(write_log_columns, result.log.path_maker(),
+                           result.log_columns.path_maker()),
+               pool.submit(write_trees_index, result.trees.path_maker(),
+                           result.trees_index.path_maker())])
+
+
+def _write_run_info(result, run_info):
+    with result.run_info.path_maker().open('w') as fh:
+        json.dump(run_info, fh, indent=2)
+
+
+# flags of a BEAST call which are about the chain rather than the hardware
+# it runs on, and their values
+_CHAIN_FLAGS = {'-seed', '-save_every', '-save_state', '-load_state'}
+
+
+def _hardware_flags(beast_call):
+    # without `beast` and the control file
+    flags = []
+    args = iter(beast_call[1:-1])
+    for arg in args:
+        if arg in _CHAIN_FLAGS:
+            next(args)
+        else:
+            flags.append(arg)
+    return flags
+
+
+def _run_beast(beast_call, result, target_ess=None, ess_params=None,
+               run_info=None, sidecars=True, cancel=None):
+    # `seconds` in run_info is time already spent on the chain, None when
+    # that is unknown. BEAST is killed if `cancel` is set while it runs.
+    run_info = dict(beast_call=beast_call, **(run_info or {}))
+    seconds = run_info.setdefault('seconds', 0)
+    _write_run_info(result, run_info)
+
+    start = time.monotonic()
+    if target_ess is None and cancel is None:
+        subprocess.run(beast_call, check=True, cwd=result.path)
+    else:
+        _run_until_converged(beast_call, result, target_ess, ess_params,
+                             cancel)
+    if seconds is not None:
+        run_info['seconds'] = seconds + time.monotonic() - start
+        _write_run_info(result, run_info)
+
+    if sidecars:
+        _write_sidecars(result)
+
+
+def _sample_ids(*series):
+    # samples which appear in every series, in the order of the first
+    ids = series[0].index
+    for other in series[1:]:
+        if other is not None:
+            ids = ids.intersection(other.index, sort=False)
+    return ids
+
+
+class _Samples:
+    # The samples of a control file, iterated by the template once per
+    # block. Sequences are kept encoded and each row is only decoded when
+    # the template reaches it, so rendering doesn't add copies of the
+    # alignment as strings.
+    def __init__(self, ids, time_series, uncertainty_series, **matrices):
+        self.ids = list(ids)
+        self.times = time_series.loc[ids].tolist()
+        if uncertainty_series is not None:
+            self.uncertainties = uncertainty_series.loc[ids].tolist()
+        else:
+            self.uncertainties = [None] * len(self.ids)
+        self.matrices = matrices
+        self._row = collections.namedtuple(
+            'Sample', ['Index', *matrices, 'time', 'time_uncertainty'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for idx, (id_, sample_time, uncertainty) in enumerate(
+                zip(self.ids, self.times, self.uncertainties)):
+            if uncertainty is not None and np.isnan(uncertainty):
+                uncertainty = None
+            yield self._row(id_, *[decode(matrix[idx])
+                                   for matrix in self.matrices.values()],
+                            sample_time, uncertainty)
+
+
+def _gtr_single_partition_kwargs(
+        alignment, time, n_generations, sample_every, time_uncertainty,
+        base_freq, site_gamma, site_invariant, clock, coalescent_model,
+        skygrid_intervals, skygrid_duration, print_every):
+    if coalescent_model == 'skygrid':
+        if skygrid_duration is None or skygrid_intervals is None:
+            raise ValueError("skygrid not parameterized (TODO: better error)")
 
     # Setup up samples for templating into control file
     seq_series = alignment.get_column('Sequence').to_series()
@@ -64,24 +373,20 @@ def gtr_single_partition(
     if time_uncertainty is not None:
         uncertainty_series = time_uncertainty.to_series()
     else:
-        uncertainty_series = time_series.copy()
-        uncertainty_series[...] = None
+        uncertainty_series = None
+
+    ids = _sample_ids(seq_series, time_series, uncertainty_series)
 
-    samples_df = pd.concat([seq_series, time_series, uncertainty_series],
-                           axis='columns', join='inner')
-    samples_df.index.name = 'id'
-    samples_df.columns = ['seq', 'time', 'time_uncertainty']
-    samples_df = samples_df.replace({pd.np.nan: None})
-    samples = list(samples_df.itertuples(index=True))
+    # Drop empty sites before BEAST has to parse them
+    matrix, alignment_info = preprocess(seq_series.loc[ids])
+    samples = _Samples(ids, time_series, uncertainty_series, seq=matrix)
 
     # Default print behavior
     if print_every is None:
         print_every = sample_every
 
-    # Generate control file for BEAST
-    template_kwargs = dict(trees_file=trees_file, ops_file=ops_file,
-                           log_file=log_file, sample_every=sample_every,
-                           print_every=print_every,
+    alignment_info['taxa'] = len(samples)
+    template_kwargs = dict(sample_every=sample_every, print_every=print_every,
                            n_generations=n_generations, time_unit='years',
                            samples=samples, base_freq=base_freq,
                            site_gamma=site_gamma,
@@ -89,18 +394,180 @@ def gtr_single_partition(
                            coalescent_model=coalescent_model,
                            skygrid_duration=skygrid_duration,
                            skygrid_intervals=skygrid_intervals)
+    return alignment_info, template_kwargs
+
+
+def gtr_single_partition(
+        alignment: qiime2.Metadata,
+        time: qiime2.NumericMetadataColumn,
+        n_generations: int,
+        sample_every: int,
+        time_uncertainty: qiime2.NumericMetadataColumn = None,
+        base_freq: str = "estimated",
+        site_gamma: int = 4,
+        site_invariant: bool = True,
+        clock: str = 'ucln',
+        coalescent_model: str = 'skygrid',
+        skygrid_intervals: int = None,
+        skygrid_duration: float = None,
+        print_every: int = None,
+        use_gpu: bool = False,
+        n_threads: int = 1,
+        tune_beagle: bool = False,
+        checkpoint_every: int = None,
+        target_ess: int = None,
+        ess_params: str = None) -> BEASTPosteriorDirFmt:
+    alignment_info, template_kwargs = _gtr_single_partition_kwargs(
+        alignment, time, n_generations, sample_every, time_uncertainty,
+        base_freq, site_gamma, site_invariant, clock, coalescent_model,
+        skygrid_intervals, skygrid_duration, print_every)
 
+    # Set up directory format where BEAST will write everything
+    result = BEASTPosteriorDirFmt()
+    control_file = str(result.control.path_maker())
+    template_kwargs.update(_output_files(result))
+
+    # Parallelization options
+    beagle = None
+    if tune_beagle:
+        beagle = _tune_beagle(
+            "gtr_single_partition.xml", template_kwargs,
+            alignment_info['taxa'], alignment_info['patterns'], use_gpu,
+            n_threads)
+    beast_call = _beast_call(use_gpu, n_threads, beagle=beagle)
+
+    # Generate control file for BEAST
     template = _get_template("gtr_single_partition.xml")
     template.stream(**template_kwargs).dump(control_file)
 
+    beast_call += _checkpoint_call(result, checkpoint_every)
     beast_call += [str(control_file)]
 
     # Execute
-    subprocess.run(beast_call, check=True, cwd=result.path)
+    _run_beast(beast_call, result, target_ess, ess_params,
+               run_info=dict(alignment=alignment_info))
 
     return result
 
 
+def gtr_single_partition_chains(
+        alignment: qiime2.Metadata,
+        time: qiime2.NumericMetadataColumn,
+        n_generations: int,
+        sample_every: int,
+        n_chains: int = 4,
+        time_uncertainty: qiime2.NumericMetadataColumn = None,
+        base_freq: str = "estimated",
+        site_gamma: int = 4,
+        site_invariant: bool = True,
+        clock: str = 'ucln',
+        coalescent_model: str = 'skygrid',
+        skygrid_intervals: int = None,
+        skygrid_duration: float = None,
+        print_every: int = None,
+        use_gpu: bool = False,
+        n_threads: int = None,
+        tune_beagle: bool = False,
+        seed: int = None,
+        checkpoint_every: int = None,
+        target_ess: int = None,
+        ess_params: str = None) -> BEASTPosteriorDirFmt:
+    # The chains are a List output, which QIIME 2 (2023.5 onwards) wants
+    # annotated with the view type of each element.
+    alignment_info, template_kwargs = _gtr_single_partition_kwargs(
+        alignment, time, n_generations, sample_every, time_uncertainty,
+        base_freq, site_gamma, site_invariant, clock, coalescent_model,
+        skygrid_intervals, skygrid_duration, print_every)
+
+    # Split the machine between the chains, each chain gets its own share of
+    # BEAGLE instances (or a single GPU instance).
+    if use_gpu:
+        threads_per_chain = 1
+    else:
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        if n_threads < n_chains:
+            raise ValueError("Cannot run %d chains concurrently with only %d"
+                             " threads." % (n_chains, n_threads))
+        threads_per_chain = n_threads // n_chains
+
+    if seed is None:
+        seed = random.randrange(1, 2**31 - n_chains)
+
+    results = [BEASTPosteriorDirFmt() for _ in range(n_chains)]
+
+    # Render once, every chain gets an identical control file (and md5sum),
+    # so they can be merged later. Only the seed differs.
+    template_kwargs.update(_output_files(results[0]))
+    control_file = str(results[0].control.path_maker())
+    template = _get_template("gtr_single_partition.xml")
+    template.stream(**template_kwargs).dump(control_file)
+    for result in results[1:]:
+        shutil.copyfile(control_file, str(result.control.path_maker()))
+
+    beagle = None
+    if tune_beagle:
+        beagle = _tune_beagle(
+            "gtr_single_partition.xml", template_kwargs,
+            alignment_info['taxa'], alignment_info['patterns'], use_gpu,
+            threads_per_chain)
+
+    beast_calls = [
+        _beast_call(use_gpu, threads_per_chain, seed=seed + idx,
+                    beagle=beagle)
+        + _checkpoint_call(result, checkpoint_every)
+        + [str(result.control.path_maker())]
+        for idx, result in enumerate(results)]
+
+    # Execute, the chains are independent BEAST processes so the pool only
+    # needs to wait on them. When one fails the others are stopped rather
+    # than left to run to n_generations.
+    cancel = threading.Event()
+
+    def run(beast_call, result):
+        try:
+            _run_beast(beast_call, result, target_ess, ess_params,
+                       dict(alignment=alignment_info), cancel=cancel)
+        except BaseException:
+            cancel.set()
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_chains) as pool:
+        runs = [pool.submit(run, beast_call, result)
+                for beast_call, result in zip(beast_calls, results)]
+    errors = [job.exception() for job in runs
+              if not isinstance(job.exception(), (_Cancelled, type(None)))]
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+# name, sequence field, first site, and stride of each partition
+_HKY_PARTITIONS = [
+    ('coding.CP1', 'seq_orf', 1, 3),
+    ('coding.CP2', 'seq_orf', 2, 3),
+    ('coding.CP3', 'seq_orf', 3, 3),
+    ('noncoding', 'seq_nc', 1, 1)]
+
+
+def _hky_allocation(matrices, n_threads):
+    # The share of `n_threads` each partition's unique site patterns call
+    # for. BEAST's -beagle_instances splits every partition into the same
+    # number of instances, and an uneven split would have to be written
+    # into the control file (stopping chains run with different thread
+    # counts from merging), so this is only recorded in run_info, for
+    # comparing against the time per generation.
+    pattern_counts = {}
+    for name, field, start, every in _HKY_PARTITIONS:
+        pattern_counts[name] = count_patterns(
+            matrices[field][:, start - 1::every])
+    threads = allocate_threads(pattern_counts, n_threads)
+    return {name: dict(patterns=pattern_counts[name],
+                       proportional_threads=threads[name])
+            for name in pattern_counts}
+
+
 def site_heterogeneous_hky(
         coding_regions: qiime2.Metadata,
         noncoding_regions: qiime2.Metadata,
@@ -110,56 +577,142 @@ def site_heterogeneous_hky(
         print_every: int = None,
         time_uncertainty: qiime2.NumericMetadataColumn = None,
         use_gpu: bool = False,
-        n_threads: int = 1) -> BEASTPosteriorDirFmt:
-
-    # Parallelization options
-    beast_call = ['beast']
-    if use_gpu:
-        if n_threads != 1:
-            raise ValueError
-        beast_call += ['-beagle_GPU', '-beagle_cuda', '-beagle_instances', '1']
-    else:
-        beast_call += ['-beagle_CPU', '-beagle_SSE',
-                       '-beagle_instances', str(n_threads)]
+        n_threads: int = 1,
+        tune_beagle: bool = False,
+        checkpoint_every: int = None,
+        target_ess: int = None,
+        ess_params: str = None) -> BEASTPosteriorDirFmt:
 
     # Set up directory format where BEAST will write everything
     result = BEASTPosteriorDirFmt()
     control_file = str(result.control.path_maker())
 
-    ops_file = str(result.ops.path_maker().relative_to(result.path))
-    log_file = str(result.log.path_maker().relative_to(result.path))
-    trees_file = str(result.trees.path_maker().relative_to(result.path))
-
     # Setup up samples for templating into control file
     orf_series = coding_regions.get_column('Sequence').to_series()
     nc_series = noncoding_regions.get_column('Sequence').to_series()
     time_series = time.to_series()
     uncertainty_series = time_uncertainty.to_series()
 
-    samples_df = pd.concat([orf_series, nc_series, time_series,
-                            uncertainty_series], axis='columns', join='inner')
-    samples_df.index.name = 'id'
-    samples_df.columns = ['seq_orf', 'seq_nc', 'time', 'time_uncertainty']
-    samples_df = samples_df.replace({pd.np.nan: None})
-    samples = list(samples_df.itertuples(index=True))
+    ids = _sample_ids(orf_series, nc_series, time_series, uncertainty_series)
+
+    # Drop empty sites (whole codons of the coding regions) before BEAST has
+    # to parse them
+    matrices = {}
+    alignment_info = {}
+    for field, series, codons in [('seq_orf', orf_series, True),
+                                  ('seq_nc', nc_series, False)]:
+        matrices[field], alignment_info[field] = preprocess(
+            series.loc[ids], codons=codons)
+    samples = _Samples(ids, time_series, uncertainty_series, **matrices)
 
     # Default print behavior
     if print_every is None:
         print_every = sample_every
 
-    # Generate control file for BEAST
-    template_kwargs = dict(trees_file=trees_file, ops_file=ops_file,
-                           log_file=log_file, sample_every=sample_every,
+    # Parallelization options
+    if use_gpu and n_threads != 1:
+        raise ValueError
+    allocation = _hky_allocation(matrices, 1 if use_gpu else n_threads)
+
+    template_kwargs = dict(sample_every=sample_every,
                            print_every=print_every,
                            n_generations=n_generations, time_unit='years',
-                           samples=samples)
+                           samples=samples, **_output_files(result))
+
+    beagle = None
+    if tune_beagle:
+        beagle = _tune_beagle(
+            "orf_and_nc.xml", template_kwargs, len(samples),
+            sum(p['patterns'] for p in allocation.values()), use_gpu,
+            n_threads)
+    beast_call = _beast_call(use_gpu, n_threads, beagle=beagle)
+
+    # Generate control file for BEAST
     template = _get_template("orf_and_nc.xml")
     template.stream(**template_kwargs).dump(control_file)
 
+    beast_call += _checkpoint_call(result, checkpoint_every)
     beast_call += [str(control_file)]
 
     # Execute
-    subprocess.run(beast_call, check=True, cwd=result.path)
+    _run_beast(beast_call, result, target_ess, ess_params,
+               run_info=dict(partitions=allocation,
+                             alignment=alignment_info))
+
+    return result
+
+
+def _first_state(path, get_state):
+    for line in _complete_lines(path):
+        state = get_state(line)
+        if state is not None:
+            return state
+    return None
+
+
+def _stitch(partial, resumed, out, get_state, footer=''):
+    # Keep `partial` up to where `resumed` picks up, then append `resumed`.
+    # Anything which isn't a sample (comments, headers, the Nexus translate
+    # table) is taken from `partial`.
+    resumed_from = _first_state(resumed, get_state)
+    lines = _complete_lines(partial)
+    if footer:
+        lines = _without_footer(lines, footer)
+    with open(str(out), 'w') as fh:
+        for line in lines:
+            state = get_state(line)
+            if state is None:
+                fh.write(line)
+            elif resumed_from is None or state < resumed_from:
+                fh.write(line)
+        for line in _complete_lines(resumed):
+            if get_state(line) is not None:
+                fh.write(line)
+        if footer:
+            fh.write(footer + '\n')
+
+
+def resume_chain(chain: BEASTPosteriorDirFmt,
+                 checkpoint_every: int = None,
+                 use_gpu: bool = None,
+                 n_threads: int = None) -> BEASTPosteriorDirFmt:
+    if not chain.checkpoint.path_maker().exists():
+        raise ValueError("This chain was not checkpointed, so it cannot be"
+                         " resumed. Use `checkpoint_every` when running"
+                         " BEAST.")
+
+    CONTROL_FMT = chain.control.format
+    result = BEASTPosteriorDirFmt()
+    result.control.write_data(chain.control.view(CONTROL_FMT),
+                              view_type=CONTROL_FMT)
+    control_file = str(result.control.path_maker())
+
+    # by default the chain runs on the same BEAGLE, thread and GPU settings
+    # as it did before
+    previous_call = read_run_info(chain).get('beast_call')
+    if use_gpu is None and n_threads is None and previous_call is not None:
+        beast_call = ['beast'] + _hardware_flags(previous_call)
+    else:
+        beast_call = _beast_call(bool(use_gpu), n_threads or 1)
+    beast_call += ['-load_state', str(chain.checkpoint.path_maker())]
+    beast_call += _checkpoint_call(result, checkpoint_every)
+    beast_call += [control_file]
+
+    _run_beast(beast_call, result, sidecars=False,
+               run_info=dict(seconds=read_run_info(chain).get('seconds')))
+
+    # BEAST wrote only the remainder of the chain, so put the samples from
+    # before the checkpoint back in front of it.
+    resumed_log = PosteriorLogFormat()
+    resumed_trees = NexusFormat()
+    shutil.move(str(result.log.path_maker()), str(resumed_log))
+    shutil.move(str(result.trees.path_maker()), str(resumed_trees))
+
+    _stitch(chain.log.path_maker(), resumed_log, result.log.path_maker(),
+            get_state=_log_row_state)
+    _stitch(chain.trees.path_maker(), resumed_trees,
+            result.trees.path_maker(), get_state=tree_state, footer='End;')
+    _write_sidecars(result)
 
     return result
 
@@ -168,61 +721,189 @@ def _log_combiner(files, out, burn_in, is_tree, resample=None):
     combiner_call = ['logcombiner', '-burnin', str(burn_in)]
     if is_tree:
         combiner_call += ['-trees']
-    if resample is not None:
+    if resample:
         combiner_call += ['-resample', str(resample)]
     combiner_call += list(map(str, files))
     combiner_call += [str(out)]
     subprocess.run(combiner_call, check=True)
 
 
-def merge_chains(chains: BEASTPosteriorDirFmt, burn_in: int,
-                 resample: int = None) -> BEASTPosteriorDirFmt:
-    if len(burn_in) > 1 and len(burn_in) != len(chains):
-        raise ValueError("burn_in")
+def _strip_trees(chain, out, burn_in):
+    copy_trees(chain.trees.path_maker(), load_trees_index(chain), out,
+               start=burn_in)
 
-    CONTROL_FMT = chains[0].control.format
-    md5sums = {c.control.view(CONTROL_FMT).md5sum() for c in chains}
-    if len(md5sums) > 1:
-        raise ValueError("Chains do not share a posterior distribution as they"
-                         " were generated with different inputs/parameters/"
-                         "priors, so they cannot be merged.")
 
+def _merge_with_logcombiner(chains, burn_in, resample, result, pool):
     if len(burn_in) > 1:
         logs_to_merge = [PosteriorLogFormat() for _ in chains]
         trees_to_merge = [NexusFormat() for _ in chains]
         # remove the burn_in first as the CLI doesn't allow these to differ
+        jobs = []
         for chain, single_burn_in, out_trees, out_log in zip(
                 chains, burn_in, trees_to_merge, logs_to_merge):
-            _log_combiner([chain.log.view(chain.log.format)],
-                          out=out_log, burn_in=single_burn_in, is_tree=False)
-            _log_combiner([chain.trees.view(chain.trees.format)],
-                          out=out_trees, burn_in=single_burn_in, is_tree=True)
+            jobs.append(pool.submit(
+                _log_combiner, [chain.log.view(chain.log.format)],
+                out=out_log, burn_in=single_burn_in, is_tree=False))
+            jobs.append(pool.submit(_strip_trees, chain, out_trees,
+                                    single_burn_in))
+        _wait(jobs)
         burn_in = 0  # disable global burn-in
     else:
         logs_to_merge = [c.log.view(c.log.format) for c in chains]
         trees_to_merge = [c.trees.view(c.trees.format) for c in chains]
         burn_in = burn_in[0]
 
+    return [pool.submit(_log_combiner, logs_to_merge,
+                        out=result.log.path_maker(), burn_in=burn_in,
+                        is_tree=False, resample=resample),
+            pool.submit(_log_combiner, trees_to_merge,
+                        out=result.trees.path_maker(), burn_in=burn_in,
+                        is_tree=True, resample=resample)]
+
+
+def _merged_result(chains, burn_in):
+    if len(burn_in) > 1 and len(burn_in) != len(chains):
+        raise ValueError("burn_in")
+
+    CONTROL_FMT = chains[0].control.format
+    md5sums = {c.control.view(CONTROL_FMT).md5sum() for c in chains}
+    if len(md5sums) > 1:
+        raise ValueError("Chains do not share a posterior distribution as they"
+                         " were generated with different inputs/parameters/"
+                         "priors, so they cannot be merged.")
+
     result = BEASTPosteriorDirFmt()
     result.control.write_data(chains[0].control.view(CONTROL_FMT),
                               view_type=CONTROL_FMT)
     with result.ops.path_maker().open('w') as fh:
         fh.write('')  # intentionally empty file
+    return result
 
-    _log_combiner(logs_to_merge, out=result.log.path_maker(), burn_in=burn_in,
-                  is_tree=False, resample=resample)
-    _log_combiner(trees_to_merge, out=result.trees.path_maker(),
-                  burn_in=burn_in, is_tree=True, resample=resample)
+
+def merge_chains(chains: BEASTPosteriorDirFmt, burn_in: int,
+                 resample: int = None, engine: str = 'logcombiner',
+                 n_jobs: int = 1) -> BEASTPosteriorDirFmt:
+    result = _merged_result(chains, burn_in)
+
+    if engine == 'native':
+        # Each chain is filtered with its own burn-in in a process of its
+        # own, as the renumbering is Python work on every line.
+        if len(burn_in) == 1:
+            burn_in = burn_in * len(chains)
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            combine_logs([c.log.path_maker() for c in chains],
+                         result.log.path_maker(), burn_in=burn_in,
+                         resample=resample, pool=pool)
+            combine_trees([c.trees.path_maker() for c in chains],
+                          result.trees.path_maker(), burn_in=burn_in,
+                          resample=resample,
+                          indexes=[load_trees_index(c) for c in chains],
+                          pool=pool)
+    else:
+        # a logcombiner process per chain, so a thread pool is enough
+        with concurrent.futures.ThreadPoolExecutor(n_jobs) as pool:
+            _wait(_merge_with_logcombiner(chains, burn_in, resample, result,
+                                          pool))
+    _write_sidecars(result)
+
+    return result
+
+
+def append_chains(posterior: BEASTPosteriorDirFmt,
+                  chains: BEASTPosteriorDirFmt, burn_in: int,
+                  resample: int = None) -> BEASTPosteriorDirFmt:
+    if len(burn_in) > 1 and len(burn_in) != len(chains):
+        raise ValueError("burn_in")
+    if len(burn_in) == 1:
+        burn_in = burn_in * len(chains)
+    # the merged posterior has already had its burn-in removed
+    result = _merged_result([posterior] + chains, [0] + burn_in)
+
+    # The samples already merged are copied as they are, only the new chains
+    # are filtered and then appended, and so are the sidecars.
+    shutil.copyfile(str(posterior.log.path_maker()),
+                    str(result.log.path_maker()))
+    shutil.copyfile(str(posterior.trees.path_maker()),
+                    str(result.trees.path_maker()))
+    log_size = os.path.getsize(str(result.log.path_maker()))
+    index = load_trees_index(posterior)
+
+    combine_logs([c.log.path_maker() for c in chains],
+                 result.log.path_maker(), burn_in=burn_in,
+                 resample=resample, append=True)
+    combine_trees([c.trees.path_maker() for c in chains],
+                  result.trees.path_maker(), burn_in=burn_in,
+                  resample=resample,
+                  indexes=[load_trees_index(c) for c in chains],
+                  out_index=index)
+
+    previous_columns = posterior.log_columns.path_maker()
+    if previous_columns.exists():
+        write_log_columns(result.log.path_maker(),
+                          result.log_columns.path_maker(),
+                          previous=previous_columns, offset=log_size)
+    else:
+        write_log_columns(result.log.path_maker(),
+                          result.log_columns.path_maker())
+    write_trees_index(result.trees.path_maker(),
+                      result.trees_index.path_maker(), previous=index)
+
+    return result
+
+
+def _clade_index_paths(clade_index):
+    return {name: getattr(clade_index, name).path_maker()
+            for name in _clade_index.ARRAYS}
+
+
+def index_clades(posterior: BEASTPosteriorDirFmt,
+                 n_jobs: int = 1) -> CladeIndexDirFmt:
+    trees = posterior.trees.path_maker()
+    with open(str(trees)) as fh:
+        _, translate = read_translate(fh)
+
+    result = CladeIndexDirFmt()
+    _clade_index.build(trees, load_trees_index(posterior),
+                       tip_bits(translate), _clade_index_paths(result),
+                       n_jobs=n_jobs)
 
     return result
 
 
 def maximum_clade_credibility(posterior: BEASTPosteriorDirFmt,
-                              burn_in: int = 0) -> NexusFormat:
+                              clade_index: CladeIndexDirFmt = None,
+                              burn_in: int = 0,
+                              engine: str = 'treeannotator',
+                              n_jobs: int = 1,
+                              heights: str = 'keep',
+                              max_trees: int = None,
+                              seed: int = None) -> NexusFormat:
     result = NexusFormat()
 
+    if engine == 'native':
+        index = load_trees_index(posterior)
+        if clade_index is not None:
+            clade_index = _clade_index.load(_clade_index_paths(clade_index))
+            if not np.array_equal(clade_index['states'], index[:, 0]):
+                raise ValueError("The clade index was not built from the"
+                                 " trees of this posterior.")
+        _mcc.maximum_clade_credibility(
+            posterior.trees.path_maker(), result, start=burn_in,
+            index=index, n_jobs=n_jobs, heights=heights,
+            clade_index=clade_index, max_trees=max_trees, seed=seed)
+        return result
+    if clade_index is not None or max_trees is not None:
+        raise ValueError("A clade index and max_trees can only be used by"
+                         " the native engine.")
+
     trees = posterior.trees.view(posterior.trees.format)
-    annotator_call = ['treeannotator', '-burnin', str(burn_in),
+    if burn_in:
+        # skip the burn-in by seeking past it rather than having
+        # treeannotator parse every tree in it
+        trees = NexusFormat()
+        copy_trees(posterior.trees.path_maker(), load_trees_index(posterior),
+                   trees, start=burn_in)
+    annotator_call = ['treeannotator', '-burnin', '0', '-heights', heights,
                       str(trees), str(result)]
     subprocess.run(annotator_call, check=True)
 
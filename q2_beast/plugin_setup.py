@@ -9,13 +9,17 @@ from q2_types.tree import Phylogeny
 
 import q2_beast
 from q2_beast.methods import (
-    site_heterogeneous_hky, merge_chains, maximum_clade_credibility,
-    gtr_single_partition)
-from q2_beast.visualizations import traceplot
-from q2_beast.types import Chain, BEAST, MCC
+    site_heterogeneous_hky, merge_chains, append_chains, index_clades,
+    maximum_clade_credibility, gtr_single_partition,
+    gtr_single_partition_chains, resume_chain)
+from q2_beast.visualizations import (
+    traceplot, effective_sample_size, convergence)
+from q2_beast.types import Chain, BEAST, MCC, CladeIndex
 from q2_beast.formats import (
-    PosteriorLogFormat, NexusFormat, BEASTControlFileFormat,
-    BEASTOpsFileFormat, BEASTPosteriorDirFmt, NexusDirFmt)
+    PosteriorLogFormat, PosteriorLogColumnsFormat, NexusFormat,
+    NexusIndexFormat, BEASTControlFileFormat, BEASTOpsFileFormat,
+    BEASTStateFileFormat, BEASTRunInfoFormat, BEASTPosteriorDirFmt,
+    NexusDirFmt, CladeIndexFormat, CladeIndexDirFmt)
 
 plugin = Plugin(
     name='beast',
@@ -28,14 +32,18 @@ plugin = Plugin(
 
 
 plugin.register_formats(
-    PosteriorLogFormat, NexusFormat, BEASTControlFileFormat,
-    BEASTOpsFileFormat, BEASTPosteriorDirFmt, NexusDirFmt)
+    PosteriorLogFormat, PosteriorLogColumnsFormat, NexusFormat,
+    NexusIndexFormat, BEASTControlFileFormat, BEASTOpsFileFormat,
+    BEASTStateFileFormat, BEASTRunInfoFormat, BEASTPosteriorDirFmt,
+    NexusDirFmt, CladeIndexFormat, CladeIndexDirFmt)
 
-plugin.register_semantic_types(Chain, BEAST, MCC)
+plugin.register_semantic_types(Chain, BEAST, MCC, CladeIndex)
 plugin.register_semantic_type_to_format(
     Chain[BEAST], artifact_format=BEASTPosteriorDirFmt)
 plugin.register_semantic_type_to_format(
     Phylogeny[MCC], artifact_format=NexusDirFmt)
+plugin.register_semantic_type_to_format(
+    CladeIndex, artifact_format=CladeIndexDirFmt)
 
 
 importlib.import_module('q2_beast.transformers')
@@ -43,57 +51,96 @@ importlib.import_module('q2_beast.transformers')
 NONZERO_INT = Int % Range(1, None)
 NONNEGATIVE_INT = Int % Range(0, None)
 
+CHECKPOINT_EVERY_DESCRIPTION = (
+    'How many generations should occur between saving the state of the'
+    ' chain. A chain which was interrupted can be continued from its last'
+    ' saved state with `resume-chain`. By default no state is saved.')
+
+TARGET_ESS_DESCRIPTION = (
+    'Stop the chain early once the effective sample size of the joint,'
+    ' prior, likelihood, and any `ess_params` reaches this value. The ESS'
+    ' is checked periodically while BEAST runs, discarding the first 10% of'
+    ' samples. `n_generations` remains the maximum length of the chain. By'
+    ' default the chain runs for all `n_generations`.')
+ESS_PARAMS_DESCRIPTION = (
+    'Additional columns of the posterior log which must reach'
+    ' `target_ess` before the chain is stopped.')
+
+TUNE_BEAGLE_DESCRIPTION = (
+    'Time short pilot runs of the control file to choose the fastest BEAGLE'
+    ' settings (SSE, instance and thread counts, and rescaling frequency)'
+    ' for `n_threads` threads. The choice is cached per host and alignment'
+    ' shape in ~/.cache/q2-beast/beagle.json, so later runs skip the'
+    ' pilots. Only applies to CPU instances.')
+
+ALIGNMENT_DESCRIPTION = (
+    'Sites which are entirely gaps or N are dropped before the control file'
+    ' is written, as they do not affect the likelihood. The rest of the'
+    ' alignment is written in full, BEAST compresses it into unique site'
+    ' patterns when it starts.')
+
+GTR_PARAMETERS = {
+    'time': MetadataColumn[Numeric],
+    'n_generations': NONZERO_INT,
+    'sample_every': NONZERO_INT,
+    'time_uncertainty': MetadataColumn[Numeric],
+    'base_freq': Str % Choices("estimated", "empirical"),
+    'site_gamma': Int % Range(0, 10, inclusive_end=True),
+    'site_invariant': Bool,
+    'clock': Str % Choices("ucln", "strict"),
+    'coalescent_model': Str % Choices("skygrid", "constant", "exponential"),
+    'skygrid_intervals': NONZERO_INT,
+    'skygrid_duration': Float % Range(0, None, inclusive_start=False),
+    'print_every': NONZERO_INT,
+    'use_gpu': Bool,
+    'n_threads': NONZERO_INT,
+    'tune_beagle': Bool,
+    'checkpoint_every': NONZERO_INT,
+    'target_ess': NONZERO_INT,
+    'ess_params': List[Str]}
+
+GTR_PARAMETER_DESCRIPTIONS = {
+    'time': 'The decimal date for when that sequence was collected.',
+    'time_uncertainty': 'Uncertainty in the collection time,'
+                        ' this should be in decimal years.',
+    'n_generations': 'The number of generations (or iterations) to run the'
+                     ' MCMC procedure for. Higher values are more likely'
+                     ' to result in samples from the posterior'
+                     ' distribution. Typical values are on the order of'
+                     ' tens of millions of generations.',
+    'sample_every': 'How many generations should occur between samples'
+                    ' which will form the chain. This is a thinning '
+                    ' parameter, and can be used to reduce autocorrelation'
+                    ' increasing your effective sample size.',
+    'base_freq': '',
+    'site_gamma': '',
+    'site_invariant': '',
+    'clock': '',
+    'coalescent_model': '',
+    'skygrid_intervals': '',
+    'skygrid_duration': '',
+    'print_every': 'How many generations should occur before printing to'
+                   ' stdout. This is a cosmetic feature, and by default'
+                   ' will match `sample_every`.',
+    'use_gpu': 'Whether to perform MCMC on a CUDA enabled GPU.',
+    'n_threads': 'The number of threads to use, TODO: this is not quite'
+                 ' accurate, as some extra math happens with partitions',
+    'tune_beagle': TUNE_BEAGLE_DESCRIPTION,
+    'checkpoint_every': CHECKPOINT_EVERY_DESCRIPTION,
+    'target_ess': TARGET_ESS_DESCRIPTION,
+    'ess_params': ESS_PARAMS_DESCRIPTION
+}
+
 plugin.methods.register_function(
     function=gtr_single_partition,
     inputs={
         'alignment': FeatureData[AlignedSequence]},
-    parameters={'time': MetadataColumn[Numeric],
-                'n_generations': NONZERO_INT,
-                'sample_every': NONZERO_INT,
-                'time_uncertainty': MetadataColumn[Numeric],
-                'base_freq': Str % Choices("estimated", "empirical"),
-                'site_gamma': Int % Range(0, 10, inclusive_end=True),
-                'site_invariant': Bool,
-                'clock': Str % Choices("ucln", "strict"),
-                'coalescent_model': Str % Choices("skygrid", "constant",
-                                                  "exponential"),
-                'skygrid_intervals': NONZERO_INT,
-                'skygrid_duration': Float % Range(0, None,
-                                                  inclusive_start=False),
-                'print_every': NONZERO_INT,
-                'use_gpu': Bool,
-                'n_threads': NONZERO_INT},
+    parameters=GTR_PARAMETERS,
     outputs=[('chain', Chain[BEAST])],
     input_descriptions={
         'alignment': 'The alignment to construct a tree with.',
     },
-    parameter_descriptions={
-        'time': 'The decimal date for when that sequence was collected.',
-        'time_uncertainty': 'Uncertainty in the collection time,'
-                            ' this should be in decimal years.',
-        'n_generations': 'The number of generations (or iterations) to run the'
-                         ' MCMC procedure for. Higher values are more likely'
-                         ' to result in samples from the posterior'
-                         ' distribution. Typical values are on the order of'
-                         ' tens of millions of generations.',
-        'sample_every': 'How many generations should occur between samples'
-                        ' which will form the chain. This is a thinning '
-                        ' parameter, and can be used to reduce autocorrelation'
-                        ' increasing your effective sample size.',
-        'base_freq': '',
-        'site_gamma': '',
-        'site_invariant': '',
-        'clock': '',
-        'coalescent_model': '',
-        'skygrid_intervals': '',
-        'skygrid_duration': '',
-        'print_every': 'How many generations should occur before printing to'
-                       ' stdout. This is a cosmetic feature, and by default'
-                       ' will match `sample_every`.',
-        'use_gpu': 'Whether to perform MCMC on a CUDA enabled GPU.',
-        'n_threads': 'The number of threads to use, TODO: this is not quite'
-                     ' accurate, as some extra math happens with partitions'
-    },
+    parameter_descriptions=GTR_PARAMETER_DESCRIPTIONS,
     output_descriptions={
         'chain': 'An output chain of (ideally) the posterior distribution for'
                  ' the phylogenetic analysis. Multiple chains should be'
@@ -101,7 +148,37 @@ plugin.methods.register_function(
                  ' posterior distribution.'
     },
     name='',
-    description='')
+    description=ALIGNMENT_DESCRIPTION)
+
+plugin.methods.register_function(
+    function=gtr_single_partition_chains,
+    inputs={
+        'alignment': FeatureData[AlignedSequence]},
+    parameters={**GTR_PARAMETERS,
+                'n_chains': NONZERO_INT,
+                'seed': NONZERO_INT},
+    outputs=[('chains', List[Chain[BEAST]])],
+    input_descriptions={
+        'alignment': 'The alignment to construct a tree with.',
+    },
+    parameter_descriptions={
+        **GTR_PARAMETER_DESCRIPTIONS,
+        'n_chains': 'The number of independent chains to run concurrently.',
+        'n_threads': 'The total number of threads to use, these will be'
+                     ' divided evenly between the chains. By default all'
+                     ' available cores are used.',
+        'seed': 'The random seed of the first chain, each following chain'
+                ' will use the next integer. By default a random seed is'
+                ' chosen.'},
+    output_descriptions={
+        'chains': 'Independent chains sharing a single control file, ready'
+                  ' to be compared and merged.'
+    },
+    name='Run multiple chains of `gtr-single-partition` concurrently.',
+    description='Render a single control file and run several independent'
+                ' BEAST chains of it at the same time, each with a distinct'
+                ' seed and its own share of the available threads. '
+                + ALIGNMENT_DESCRIPTION)
 
 plugin.methods.register_function(
     function=site_heterogeneous_hky,
@@ -114,7 +191,11 @@ plugin.methods.register_function(
                 'sample_every': NONZERO_INT,
                 'print_every': NONZERO_INT,
                 'use_gpu': Bool,
-                'n_threads': NONZERO_INT},
+                'n_threads': NONZERO_INT,
+                'tune_beagle': Bool,
+                'checkpoint_every': NONZERO_INT,
+                'target_ess': NONZERO_INT,
+                'ess_params': List[Str]},
     outputs=[('chain', Chain[BEAST])],
     input_descriptions={
         'coding_regions': 'An alignment of concatenated open reading frames.',
@@ -137,8 +218,17 @@ plugin.methods.register_function(
                        ' stdout. This is a cosmetic feature, and by default'
                        ' will match `sample_every`.',
         'use_gpu': 'Whether to perform MCMC on a CUDA enabled GPU.',
-        'n_threads': 'The number of threads to use, TODO: this is not quite'
-                     ' accurate, as some extra math happens with partitions'
+        'n_threads': 'The number of BEAGLE instances to run on CPU threads,'
+                     ' each partition is split between all of them. The'
+                     ' share of threads each partition\'s number of unique'
+                     ' site patterns calls for is recorded in the'
+                     ' run_info.json of the resulting chain. The control'
+                     ' file does not depend on this, so chains run with'
+                     ' different numbers of threads can be merged.',
+        'tune_beagle': TUNE_BEAGLE_DESCRIPTION,
+        'checkpoint_every': CHECKPOINT_EVERY_DESCRIPTION,
+        'target_ess': TARGET_ESS_DESCRIPTION,
+        'ess_params': ESS_PARAMS_DESCRIPTION
     },
     output_descriptions={
         'chain': 'An output chain of (ideally) the posterior distribution for'
@@ -147,13 +237,46 @@ plugin.methods.register_function(
                  ' posterior distribution.'
     },
     name='',
-    description='')
+    description=ALIGNMENT_DESCRIPTION)
+
+plugin.methods.register_function(
+    function=resume_chain,
+    inputs={'chain': Chain[BEAST]},
+    parameters={'checkpoint_every': NONZERO_INT,
+                'use_gpu': Bool,
+                'n_threads': NONZERO_INT},
+    outputs=[('resumed_chain', Chain[BEAST])],
+    input_descriptions={
+        'chain': 'A partial chain which was saved with `checkpoint_every`,'
+                 ' such as the working directory of an interrupted run'
+                 ' imported as a Chain[BEAST].'
+    },
+    parameter_descriptions={
+        'checkpoint_every': CHECKPOINT_EVERY_DESCRIPTION,
+        'use_gpu': 'Whether to perform MCMC on a CUDA enabled GPU. By'
+                   ' default, as with `n_threads`, the chain is resumed with'
+                   ' the BEAGLE, thread and GPU settings it was run with'
+                   ' (recorded in its run_info.json), or on a single CPU'
+                   ' thread when there are none.',
+        'n_threads': 'The number of BEAGLE instances to run on CPU threads,'
+                     ' replacing the settings the chain was run with.'
+    },
+    output_descriptions={
+        'resumed_chain': 'The chain continued from its last saved state until'
+                         ' the number of generations in its control file.'
+                         ' Samples from before that state are kept.'
+    },
+    name='Resume a checkpointed chain.',
+    description='Continue an interrupted BEAST chain from its last saved'
+                ' state, appending to its posterior log and trees.')
 
 plugin.methods.register_function(
     function=merge_chains,
     inputs={'chains': List[Chain[BEAST]]},
     parameters={'burn_in': List[NONNEGATIVE_INT],
-                'resample': NONNEGATIVE_INT},
+                'resample': NONZERO_INT,
+                'engine': Str % Choices('native', 'logcombiner'),
+                'n_jobs': NONZERO_INT},
     outputs=[('posterior', Chain[BEAST])],
     input_descriptions={
         'chains': 'A list of BEAST chains to merge together.'
@@ -168,7 +291,14 @@ plugin.methods.register_function(
         'resample': 'Will preform additional thinning on each chain before'
                     ' merging. This value is in generations (not samples!)'
                     ' and must be an even multiple of the original sampling'
-                    ' rate.'  # why can't BEAST just use iter and thin?
+                    ' rate.',  # why can't BEAST just use iter and thin?
+        'engine': 'How the chains are combined. `logcombiner` uses the'
+                  ' BEAST tool, `native` filters and renumbers the samples'
+                  ' and trees in a single pass without starting Java.',
+        'n_jobs': 'How many chains to process at the same time. Each chain'
+                  ' is filtered independently, by a logcombiner process or'
+                  ' (`native`) a process of its own, so this is mostly'
+                  ' limited by the disks the chains are stored on.'
     },
     output_descriptions={
         'posterior': 'A merged chain of posterior samples.'},
@@ -176,12 +306,91 @@ plugin.methods.register_function(
     description='Merge multiple posterior chains, remove burn-in, and thin.')
 
 plugin.methods.register_function(
-    function=maximum_clade_credibility,
+    function=append_chains,
+    inputs={'posterior': Chain[BEAST],
+            'chains': List[Chain[BEAST]]},
+    parameters={'burn_in': List[NONNEGATIVE_INT],
+                'resample': NONZERO_INT},
+    outputs=[('appended_posterior', Chain[BEAST])],
+    input_descriptions={
+        'posterior': 'A chain produced by `merge-chains` (or an earlier'
+                     ' `append-chains`).',
+        'chains': 'New BEAST chains of the same posterior distribution to'
+                  ' add to it.'
+    },
+    parameter_descriptions={
+        'burn_in': 'The number of generations (not samples!) to treat as the'
+                   ' warmup period of each new chain. If a single value is'
+                   ' given, then all new chains will be given the same'
+                   ' burn-in.',
+        'resample': 'Will preform additional thinning on each new chain.'
+                    ' This should be the value used to merge `posterior`.'
+    },
+    output_descriptions={
+        'appended_posterior': 'The merged chain with the new chains\''
+                              ' samples after its own.'},
+    name='Add chains to a merged posterior.',
+    description='Remove burn-in from and thin new chains, and append them to'
+                ' an existing merged chain without processing its samples'
+                ' again.')
+
+plugin.methods.register_function(
+    function=index_clades,
     inputs={'posterior': Chain[BEAST]},
-    parameters={'burn_in': NONNEGATIVE_INT},
+    parameters={'n_jobs': NONZERO_INT},
+    outputs=[('clade_index', CladeIndex)],
+    input_descriptions={
+        'posterior': 'The chain whose trees should be indexed.'
+    },
+    parameter_descriptions={
+        'n_jobs': 'How many processes the trees are split between.'
+    },
+    output_descriptions={
+        'clade_index': 'The clades of every tree with their heights and'
+                       ' rates, which `maximum-clade-credibility` can use'
+                       ' for any burn-in without reading the trees again.'
+    },
+    name='Index the clades of a BEAST chain.',
+    description='Parse every tree of a chain once and record the clades'
+                ' each one contains, so that summary trees for different'
+                ' burn-ins can be found without parsing the trees again.')
+
+plugin.methods.register_function(
+    function=maximum_clade_credibility,
+    inputs={'posterior': Chain[BEAST],
+            'clade_index': CladeIndex},
+    parameters={'burn_in': NONNEGATIVE_INT,
+                'engine': Str % Choices('treeannotator', 'native'),
+                'n_jobs': NONZERO_INT,
+                'heights': Str % Choices('keep', 'mean', 'median', 'ca'),
+                'max_trees': NONZERO_INT,
+                'seed': NONZERO_INT},
     outputs=[('tree', Phylogeny[MCC])],
-    input_descriptions={},
-    parameter_descriptions={},
+    input_descriptions={
+        'clade_index': 'The result of `index-clades` for `posterior`. The'
+                       ' `native` engine then only reads the trees again for'
+                       ' `ca` heights.'
+    },
+    parameter_descriptions={
+        'engine': 'How the tree is found. `treeannotator` uses the BEAST'
+                  ' tool, `native` streams the trees twice, counting clades'
+                  ' and then scoring every tree, without starting Java.',
+        'n_jobs': 'How many processes the `native` engine splits the trees'
+                  ' between.',
+        'heights': 'The node heights of the tree. `keep` uses the heights of'
+                   ' the tree as it was sampled, `mean` and `median` those of'
+                   ' each clade across all trees containing it, and `ca` the'
+                   ' mean height of the common ancestor of each clade\'s taxa'
+                   ' across all trees.',
+        'max_trees': 'Summarize a uniform random sample of at most this many'
+                     ' trees after the burn-in instead of all of them, for'
+                     ' a quick approximate tree. The bound on how far each'
+                     ' clade\'s sampled frequency can be from its exact one'
+                     ' is written as a comment in the output.',
+        'seed': 'The random seed of the sample of `max_trees` trees, which'
+                ' is also written in the output. By default a random seed'
+                ' is chosen.'
+    },
     output_descriptions={},
     name='Create a Maximum Clade Credibility tree from BEAST.',
     description='Calculate the Maximum Clade Credibility tree from a BEAST'
@@ -192,15 +401,63 @@ plugin.methods.register_function(
 plugin.visualizers.register_function(
     function=traceplot,
     inputs={'chains': List[Chain[BEAST]]},
-    parameters={'params': List[Str]},
+    parameters={'params': List[Str], 'max_points': Int % Range(3, None)},
     input_descriptions={},
     parameter_descriptions={
         'params': 'Additional parameter traces to plot. By default only the'
-                  ' log-likelihood is plotted.'},
+                  ' log-likelihood is plotted.',
+        'max_points': 'The most points to plot of each chain\'s trace of a'
+                      ' parameter. Longer traces are downsampled keeping'
+                      ' their shape (largest-triangle-three-buckets), the'
+                      ' histograms still count every sample.'},
     name='Create traceplots of BEAST chains.',
     description=''
 )
 
+plugin.visualizers.register_function(
+    function=effective_sample_size,
+    inputs={'chains': List[Chain[BEAST]]},
+    parameters={'burn_in': NONNEGATIVE_INT},
+    input_descriptions={
+        'chains': 'The chains to compute the effective sample size of.'
+    },
+    parameter_descriptions={
+        'burn_in': 'The number of generations (not samples!) to discard from'
+                   ' the start of every chain.'
+    },
+    name='Tabulate effective sample sizes of BEAST chains.',
+    description='Compute the effective sample size, effective samples per'
+                ' hour of running BEAST (when the run was timed), and'
+                ' integrated autocorrelation time of every column of every'
+                ' chain\'s posterior log. The table can be downloaded as'
+                ' metadata.'
+)
+
+
+plugin.visualizers.register_function(
+    function=convergence,
+    inputs={'chains': List[Chain[BEAST]]},
+    parameters={'burn_in': NONNEGATIVE_INT,
+                'rhat_threshold': Float % Range(1, None)},
+    input_descriptions={
+        'chains': 'The chains to compare, they must share a posterior'
+                  ' distribution.'
+    },
+    parameter_descriptions={
+        'burn_in': 'The number of generations (not samples!) to discard from'
+                   ' the start of every chain.',
+        'rhat_threshold': 'Parameters with an R-hat above this have not'
+                          ' converged.'
+    },
+    name='Tabulate convergence diagnostics across BEAST chains.',
+    description='Compute the rank-normalized split R-hat, bulk effective'
+                ' sample size and tail effective sample size of every column'
+                ' of the posterior logs, over the samples from the same'
+                ' generations of every chain (Vehtari et al. 2021). Parameters'
+                ' with an R-hat above the threshold are flagged as not'
+                ' converged. The table can be downloaded as metadata.'
+)
+
 
 def not_real(output_dir: str, nope: int = None):
     pass
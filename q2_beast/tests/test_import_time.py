@@ -0,0 +1,27 @@
+import importlib.util
+import os
+import unittest
+
+
+# the check lives with the benchmarks so it can also be run on its own
+_SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                       'benchmarks', 'import_time.py')
+
+
+@unittest.skipUnless(os.path.exists(_SCRIPT),
+                     'the benchmarks are only in a source checkout')
+class TestImportTime(unittest.TestCase):
+    def setUp(self):
+        spec = importlib.util.spec_from_file_location('import_time', _SCRIPT)
+        self.import_time = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.import_time)
+
+    def test_plugin_setup(self):
+        own_ms, loaded = self.import_time.measure()
+
+        self.assertLessEqual(own_ms, self.import_time.BUDGET_MS)
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
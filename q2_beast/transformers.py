@@ -1,9 +1,15 @@
 import pandas as pd
 
 from q2_beast.plugin_setup import plugin
-from q2_beast.formats import PosteriorLogFormat
+from q2_beast.formats import BEASTPosteriorDirFmt, PosteriorLogFormat
+from q2_beast._posterior_log import read_chain_log, read_posterior_log
 
 
 @plugin.register_transformer
 def _1(ff: PosteriorLogFormat) -> pd.DataFrame:
-    return pd.read_csv(str(ff), sep='\t', skip_blank_lines=True, comment='#')
+    return read_posterior_log(str(ff))
+
+
+@plugin.register_transformer
+def _2(ff: BEASTPosteriorDirFmt) -> pd.DataFrame:
+    return read_chain_log(ff)
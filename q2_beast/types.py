@@ -5,3 +5,4 @@ from q2_types.tree import Phylogeny
 Chain = SemanticType('Chain', field_names='posterior')
 BEAST = SemanticType('BEAST', variant_of=Chain.field['posterior'])
 MCC = SemanticType('MCC', variant_of=Phylogeny.field['type'])
+CladeIndex = SemanticType('CladeIndex')
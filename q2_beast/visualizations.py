@@ -1,13 +1,41 @@
 import os
 
+import numpy as np
 import pandas as pd
-import altair as alt
+import qiime2
 
 from q2_beast.formats import BEASTPosteriorDirFmt
+from q2_beast._diagnostics import (
+    integrated_autocorrelation_time, convergence as _convergence)
+from q2_beast._downsample import lttb
+from q2_beast._posterior_log import read_chain_log, read_run_info
+
+
+# histograms of every sample are counted for this many burn-in steps
+_BURN_IN_STEPS = 100
+_HISTOGRAM_BINS = 30
+
+
+def _histogram(param, logs, edges, block):
+    # counts of each chain's samples per bin and burn-in step, so the
+    # burn-in slider can still filter them
+    tables = []
+    for name, log in logs:
+        bins = np.clip(np.searchsorted(edges, log[param], side='right') - 1,
+                       0, len(edges) - 2)
+        counts = pd.DataFrame({'state': log['state'] // block * block,
+                               'bin': bins}).value_counts().reset_index()
+        tables.append(pd.DataFrame(
+            {'state': counts['state'], 'bin_start': edges[counts['bin']],
+             'bin_end': edges[counts['bin'] + 1],
+             'count': counts.iloc[:, -1], 'CHAIN': name}))
+    return pd.concat(tables)
 
 
 def traceplot(output_dir: str, chains: BEASTPosteriorDirFmt,
-              params: str = None):
+              params: str = None, max_points: int = 5000):
+    import altair as alt  # slow to import, so only when visualizing
+
     CONTROL_FMT = chains[0].control.format
     md5sums = {c.control.view(CONTROL_FMT).md5sum() for c in chains}
     if len(md5sums) > 1:
@@ -17,25 +45,45 @@ def traceplot(output_dir: str, chains: BEASTPosteriorDirFmt,
     if params is None:
         params = []
     params = list(reversed(params)) + ['likelihood']
-    dfs = []
+    logs = []
     for idx, chain in enumerate(chains, 1):
-        df = chain.log.view(pd.DataFrame)[['state'] + params]
-        df['CHAIN'] = 'Chain %d' % idx
-        dfs.append(df)
+        log = read_chain_log(chain, columns=['state'] + params,
+                             dtype=np.float32)
+        logs.append(('Chain %d' % idx, log))
 
-    data = pd.concat(dfs)
+    gen_end = max(log['state'].iloc[-1] for _, log in logs)
+    gen_step = logs[0][1]['state'].iloc[-1] - logs[0][1]['state'].iloc[-2]
+    block = gen_step * max(1, int(np.ceil(gen_end / gen_step
+                                          / _BURN_IN_STEPS)))
 
-    url = 'data.json'
-    gen_end = data['state'].iloc[-1]
-    gen_step = gen_end - data['state'].iloc[-2]
+    # each chain's traces are downsampled to at most max_points, keeping
+    # their shape, the histograms count every sample
+    traces = {param: [] for param in params}
+    for name, log in logs:
+        states = log['state'].to_numpy()
+        kept = lttb(states, log[params].to_numpy(), max_points)
+        for column, param in enumerate(params):
+            rows = kept[:, column]
+            traces[param].append(pd.DataFrame(
+                {'state': states[rows], param: log[param].to_numpy()[rows],
+                 'CHAIN': name}))
 
-    slider = alt.binding_range(min=0, max=gen_end, step=gen_step,
+    slider = alt.binding_range(min=0, max=gen_end, step=block,
                                name='Burn-in: ')
     selector = alt.selection_single(name="BurnIn", fields=['burnin'],
                                     bind=slider, init={'burnin': 0})
     traceplots = []
-    for param in params:
-        line = alt.Chart(url).mark_line(
+    for idx, param in enumerate(params):
+        trace_url = 'trace-%d.json' % idx
+        pd.concat(traces[param]).to_json(
+            os.path.join(output_dir, trace_url), orient='records')
+        values = np.concatenate([log[param].to_numpy() for _, log in logs])
+        edges = np.histogram_bin_edges(values, bins=_HISTOGRAM_BINS)
+        histogram_url = 'histogram-%d.json' % idx
+        _histogram(param, logs, edges, block).to_json(
+            os.path.join(output_dir, histogram_url), orient='records')
+
+        line = alt.Chart(trace_url).mark_line(
             interpolate='step-after',
             opacity=0.8
         ).encode(
@@ -48,9 +96,10 @@ def traceplot(output_dir: str, chains: BEASTPosteriorDirFmt,
             alt.datum.state >= selector.burnin
         ).properties(width=800).interactive(bind_y=False)
 
-        hist = alt.Chart(url).mark_bar().encode(
-            x=alt.X('count()', title='Frequency'),
-            y=alt.Y(param, type='quantitative', bin=alt.Bin(), title=None),
+        hist = alt.Chart(histogram_url).mark_bar().encode(
+            x=alt.X('sum(count):Q', title='Frequency'),
+            y=alt.Y('bin_start:Q', bin='binned', title=None),
+            y2='bin_end:Q',
             color='CHAIN:N'
         ).transform_filter(
             alt.datum.state >= selector.burnin
@@ -62,4 +111,83 @@ def traceplot(output_dir: str, chains: BEASTPosteriorDirFmt,
     dash = alt.vconcat(*traceplots)
 
     dash.save(os.path.join(output_dir, 'index.html'))
-    data.to_json(os.path.join(output_dir, url), orient='records')
+
+
+def effective_sample_size(output_dir: str, chains: BEASTPosteriorDirFmt,
+                          burn_in: int = 0):
+    tables = []
+    for idx, chain in enumerate(chains, 1):
+        log = read_chain_log(chain)
+        log = log[log['state'] >= burn_in]
+        if len(log) < 2:
+            raise ValueError("Chain %d has fewer than two samples after the"
+                             " burn-in." % idx)
+        params = [column for column in log.columns if column != 'state']
+        # every column at once
+        iat = integrated_autocorrelation_time(log[params].to_numpy())
+        ess = len(log) / iat
+        seconds = read_run_info(chain).get('seconds')
+        hours = np.nan if not seconds else seconds / 3600
+
+        name = 'Chain %d' % idx
+        tables.append(pd.DataFrame(
+            {'chain': name, 'parameter': params, 'ess': ess,
+             'ess_per_hour': ess / hours,
+             'integrated_autocorrelation_time': iat},
+            index=pd.Index(['%s: %s' % (name, param) for param in params],
+                           name='id')))
+    table = pd.concat(tables)
+
+    qiime2.Metadata(table).save(os.path.join(output_dir, 'ess.tsv'))
+    with open(os.path.join(output_dir, 'index.html'), 'w') as fh:
+        fh.write('<html><body>\n<p><a href="ess.tsv">Download as'
+                 ' metadata</a></p>\n')
+        fh.write(table.to_html(index=False, float_format='%.1f',
+                               na_rep='', border=0))
+        fh.write('\n</body></html>\n')
+
+
+def convergence(output_dir: str, chains: BEASTPosteriorDirFmt,
+                burn_in: int = 0, rhat_threshold: float = 1.01):
+    CONTROL_FMT = chains[0].control.format
+    md5sums = {c.control.view(CONTROL_FMT).md5sum() for c in chains}
+    if len(md5sums) > 1:
+        raise ValueError("Chains do not share a posterior distribution as they"
+                         " were generated with different inputs/parameters/"
+                         "priors, so they cannot be compared.")
+    logs = []
+    for chain in chains:
+        log = read_chain_log(chain)
+        logs.append(log[log['state'] >= burn_in].set_index('state'))
+    # only the states every chain sampled, so the draws line up
+    states = logs[0].index
+    for log in logs[1:]:
+        states = states.intersection(log.index)
+    if len(states) < 8:
+        raise ValueError("The chains share fewer than eight samples after the"
+                         " burn-in.")
+    params = list(logs[0].columns)
+    # chains x draws x parameters
+    draws = np.stack([log.loc[states, params].to_numpy() for log in logs])
+
+    rhat, ess_bulk, ess_tail = _convergence(draws).T
+    table = pd.DataFrame(
+        {'rhat': rhat, 'ess_bulk': ess_bulk, 'ess_tail': ess_tail,
+         # constant columns have no R-hat (NaN), so are flagged too
+         'converged': np.where(rhat <= rhat_threshold, 'yes', 'no')},
+        index=pd.Index(params, name='id'))
+    # the worst first
+    table = table.sort_values('rhat', ascending=False, na_position='first')
+
+    qiime2.Metadata(table).save(os.path.join(output_dir, 'convergence.tsv'))
+    flagged = (table['converged'] == 'no').sum()
+    with open(os.path.join(output_dir, 'index.html'), 'w') as fh:
+        fh.write('<html><body>\n<p>%d chains of %d samples, %d of %d'
+                 ' parameters have an R-hat above %g or none at all.</p>\n'
+                 % (len(chains), len(states), flagged, len(table),
+                    rhat_threshold))
+        fh.write('<p><a href="convergence.tsv">Download as metadata</a></p>'
+                 '\n')
+        fh.write(table.rename_axis('parameter').reset_index().to_html(
+            index=False, float_format='%.3f', na_rep='', border=0))
+        fh.write('\n</body></html>\n')